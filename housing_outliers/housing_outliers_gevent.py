@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Serve housing_outliers with gevent, for many concurrent requests per worker.
+
+Blocking socket I/O, including pymongo's, is made cooperative by gevent's
+monkey patching, so a request waiting on Mongo does not tie up a thread.
+Model inference is CPU bound and runs on a bounded pool of real threads to
+keep it off the event loop.
+
+Usage: PORT=5000 INFERENCE_THREADS=4 python housing_outliers_gevent.py
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
+
+import housing_outliers_server as server
+
+def main():
+    server.inference_pool = ThreadPool(int(os.environ.get("INFERENCE_THREADS", 4)))
+    # bounds the number of requests in progress, the rest wait in the listen backlog
+    spawn = Pool(int(os.environ.get("MAX_CONNECTIONS", 1000)))
+    http_server = WSGIServer(('', int(os.environ.get("PORT", 5000))), server.app, spawn=spawn)
+    print "Serving housing_outliers with gevent on port %i" % http_server.server_port
+    http_server.serve_forever()
+
+if __name__ == '__main__':
+    main()
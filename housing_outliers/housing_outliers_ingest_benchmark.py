@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the ingest path of housing_outliers against the previous implementation.
+
+Compares jsonschema.validate followed by the previous DB.add field encoding
+and hashing with validate_entry and hash_entry, and checks that both produce
+the same hash for every entry so existing hash values stay valid.
+
+Usage: python housing_outliers_ingest_benchmark.py [--entries 20000]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+import jsonschema
+
+import housing_outliers_loadtest as loadtest
+
+def legacy_prepare(entry, housing_schema):
+    """Validation, encoding and hashing as done per POST before validate_entry and hash_entry."""
+    jsonschema.validate(entry, housing_schema)
+    for required_field in housing_schema['required']:
+        if required_field not in entry:
+            return False, "Missing required field '%s'" % required_field
+
+    for field in entry.keys():
+        if housing_schema['properties'][field]['type'] == "string":
+            if field in housing_schema['required'] and entry[field] == "":
+                return False, "Field '%s' is empty" % field
+            entry[field] = entry[field].encode('utf-8')
+
+    str_to_hash = '.'.join(str(entry[field]) for field in housing_schema['required'] if field != "price")
+    entry_hash = hashlib.sha1()
+    entry_hash.update(str_to_hash)
+
+    entry['date'] = time.time() * 1000
+    entry['hash'] = entry_hash.hexdigest()
+    return True, entry
+
+def prepare(entry, server):
+    """Validation, encoding and hashing as done by DB.add."""
+    result, ret = server.validate_entry(entry)
+    if result:
+        server.hash_entry(entry)
+    return result, ret
+
+def timed_run(function, entries):
+    """Call function on copies of entries, return (seconds, results)."""
+    entries = copy.deepcopy(entries)
+    start_time = time.time()
+    results = [function(entry) for entry in entries]
+    return time.time() - start_time, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # the server module connects and loads its model on import
+        model_file = os.path.join(tmpdir, "model.dat")
+        loadtest.write_synthetic_model(model_file, args.seed)
+        os.environ.update({'MONGODB_URI': 'mongomock', 'MODEL_FILE': model_file, 'MODEL_RELOAD_INTERVAL': '0'})
+        import housing_outliers_server as server
+
+        rng = random.Random(args.seed)
+        # decoded JSON, as the routes see it
+        entries = [json.loads(json.dumps(loadtest.synthetic_apartment(rng, i))) for i in range(args.entries)]
+        entries[0]['area'] = u"Töölö"
+
+        legacy_seconds, legacy_results = timed_run(lambda entry: legacy_prepare(entry, server.housing_schema), entries)
+        seconds, results = timed_run(lambda entry: prepare(entry, server), entries)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    mismatches = sum(1 for (legacy_ok, legacy_entry), (ok, entry) in zip(legacy_results, results)
+                     if not (legacy_ok and ok and legacy_entry['hash'] == entry['hash']))
+    print json.dumps({'entries': args.entries,
+                      'legacy_us_per_entry': legacy_seconds / args.entries * 1e6,
+                      'normalize_us_per_entry': seconds / args.entries * 1e6,
+                      'speedup': legacy_seconds / seconds if seconds > 0 else None,
+                      'hash_mismatches': mismatches}, indent=2, sort_keys=True)
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
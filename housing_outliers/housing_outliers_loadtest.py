@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Benchmark housing_outliers throughput, latency and memory per serving mode.
+
+Each serving mode (Flask, gevent) is started as a subprocess against a local
+mongod or the in-process mongomock stand-in (--mongo mongomock, the default)
+and a synthetic model that accepts housing_schema features. The POST, GET and
+/predict routes are then driven at each requested concurrency. Requests per
+second, p50/p95/p99 latency and the server's resident memory are reported as
+JSON.
+
+Usage: python housing_outliers_loadtest.py [--modes flask,gevent] [--routes predict,apartments_get,apartments_post,apartments_bulk]
+                                           [--requests 2000] [--concurrency 1,10,50] [--mongo mongomock|mongodb://...]
+                                           [--model model.dat] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import pickle
+import urllib
+import urllib2
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    "flask": "housing_outliers_server.py",
+    "gevent": "housing_outliers_gevent.py",
+}
+
+AREACODES = ["%05i" % (i * 10) for i in range(10, 60)]
+
+def write_synthetic_model(model_file, seed=0):
+    """Train a small regression model on synthetic apartments and pickle it like workflowdemo/model.dat."""
+    import numpy as np
+    from sklearn.preprocessing import LabelEncoder
+    from sklearn import linear_model
+
+    rng = np.random.RandomState(seed)
+    areacode_le = LabelEncoder().fit(AREACODES)
+    samples = 1000
+    # columns as in housing_outliers_server.FEATURES
+    features = np.column_stack([rng.randint(0, len(AREACODES), samples),
+                                rng.uniform(20, 150, samples),
+                                rng.randint(1900, 2018, samples),
+                                rng.randint(0, 2, samples),
+                                rng.randint(1, 4, samples),
+                                rng.randint(1, 8, samples),
+                                rng.randint(1, 8, samples)]).astype(float)
+    prices = features[:, 1] * 4000 + (features[:, 2] - 1900) * 500 + rng.normal(0, 10000, samples)
+    predictor = linear_model.LinearRegression().fit(features, prices)
+    with open(model_file, 'wb') as f:
+        pickle.dump({'predictor': predictor, 'areacode_encoder': areacode_le}, f)
+
+def synthetic_apartment(rng, i):
+    """Return an apartment matching housing_schema, unique for each i."""
+    size = rng.randint(20, 150)
+    return {"area": "Area %i" % rng.randint(0, 100),
+            "areacode": rng.choice(AREACODES),
+            "desc": "Synthetic apartment %i %08x" % (i, rng.getrandbits(32)),
+            "type": rng.choice(["kt", "rt", "ok"]),
+            "size": size,
+            "price": size * 4000 + rng.randint(-20000, 20000),
+            "year": str(rng.randint(1900, 2017)),
+            "floor": rng.randint(1, 8),
+            "elevator": rng.randint(0, 1),
+            "condition": rng.randint(1, 3),
+            "energy": "C",
+            "rooms": rng.randint(1, 5),
+            "city": "Helsinki",
+            "floors": rng.randint(1, 8)}
+
+def predict_query(rng):
+    # few distinct combinations, like listing pages repeating the same apartments
+    return {"areacode": rng.choice(AREACODES[:5]), "year": str(rng.choice([1960, 1980, 2000])),
+            "size": str(rng.choice([40, 60, 80])), "elevator": "1", "condition": "2",
+            "floor": str(rng.randint(1, 3)), "floors": "5"}
+
+def build_requests(base_url, route, count, rng):
+    """Return a list of (method, url, body, headers) requests for a route."""
+    json_headers = {"Content-Type": "application/json"}
+    if route == "predict":
+        return [("GET", base_url + "/predict?" + urllib.urlencode(predict_query(rng)), None, {})
+                for i in range(count)]
+    if route == "apartments_get":
+        return [("GET", base_url + "/apartments?count=20", None, {})] * count
+    if route == "apartments_post":
+        return [("POST", base_url + "/apartments", json.dumps(synthetic_apartment(rng, i)), json_headers)
+                for i in range(count)]
+    if route == "apartments_bulk":
+        # count is the number of apartments, sent 100 per request
+        return [("POST", base_url + "/apartments/bulk",
+                 json.dumps([synthetic_apartment(rng, i + j) for j in range(min(100, count - i))]), json_headers)
+                for i in range(0, count, 100)]
+    raise ValueError("Unknown route %s" % route)
+
+def start_server(mode, port, env, startup_timeout=60):
+    """Start a server subprocess and wait until it responds."""
+    env = dict(os.environ, PORT=str(port), **env)
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, SERVERS[mode])], cwd=HERE, env=env)
+    start_time = time.time()
+    while time.time() - start_time < startup_timeout:
+        try:
+            # /predict/cache answers once the app is imported, the first predict waits for the model
+            urllib2.urlopen("http://127.0.0.1:%i/predict/cache" % port, timeout=1).read()
+            return process
+        except Exception:
+            if process.poll() is not None:
+                raise RuntimeError("%s server exited with code %i" % (mode, process.returncode))
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("%s server did not start within %i seconds" % (mode, startup_timeout))
+
+def process_memory(pid):
+    """Return current and peak resident memory of a process in bytes, from /proc on Linux."""
+    memory = {'rss_bytes': None, 'peak_rss_bytes': None}
+    try:
+        with open("/proc/%i/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory['rss_bytes'] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    memory['peak_rss_bytes'] = int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return memory
+
+def run_load(requests, concurrency):
+    """Send requests from concurrent threads, return (latencies, errors, seconds)."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    pending = list(reversed(requests))
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                method, url, body, headers = pending.pop()
+            start_time = time.time()
+            try:
+                req = urllib2.Request(url, body, headers)
+                req.get_method = lambda: method
+                urllib2.urlopen(req, timeout=30).read()
+                error = None
+            except urllib2.HTTPError, ex:
+                # 400 for duplicate entries is an expected answer
+                error = None if ex.code == 400 else ex.code
+            except Exception, ex:
+                error = str(ex)
+            elapsed = time.time() - start_time
+            with lock:
+                latencies.append(elapsed)
+                if error is not None:
+                    errors.append(error)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.time() - start_time
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def summarize(latencies, errors, seconds):
+    result = {'requests': len(latencies),
+              'errors': len(errors),
+              'seconds': seconds,
+              'requests_per_second': len(latencies) / seconds if seconds > 0 else None}
+    for p in (50, 95, 99):
+        result['p%i_ms' % p] = percentile(latencies, p) * 1000 if latencies else None
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', default="flask,gevent")
+    parser.add_argument('--routes', default="apartments_post,apartments_bulk,apartments_get,predict")
+    parser.add_argument('--requests', type=int, default=2000, help="requests per route and concurrency")
+    parser.add_argument('--concurrency', default="1,10,50", help="comma separated concurrency levels")
+    parser.add_argument('--mongo', default="mongomock", help="mongomock or a MongoDB URI")
+    parser.add_argument('--model', help="model file to use instead of a synthetic one")
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write JSON results to a file instead of stdout")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        model_file = args.model
+        if model_file is None:
+            model_file = os.path.join(tmpdir, "model.dat")
+            write_synthetic_model(model_file, args.seed)
+        env = {'MODEL_FILE': os.path.abspath(model_file), 'MONGODB_URI': args.mongo}
+
+        results = []
+        for mode in args.modes.split(','):
+            process = start_server(mode, args.port, env)
+            try:
+                base_url = "http://127.0.0.1:%i" % args.port
+                for concurrency in [int(c) for c in args.concurrency.split(',')]:
+                    for route in args.routes.split(','):
+                        # a separate seed per run keeps posted apartments unique across runs
+                        rng = random.Random("%i-%s-%i" % (args.seed, route, concurrency))
+                        requests = build_requests(base_url, route, args.requests, rng)
+                        result = summarize(*run_load(requests, concurrency))
+                        result.update(process_memory(process.pid))
+                        result.update({'mode': mode, 'route': route, 'concurrency': concurrency})
+                        print >> sys.stderr, ("%(mode)-8s %(route)-16s c=%(concurrency)-4i %(requests_per_second)8.1f req/s"
+                                              "  p50 %(p50_ms)7.1f ms  p99 %(p99_ms)7.1f ms  %(errors)i errors" % result)
+                        results.append(result)
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = json.dumps({'python': platform.python_version(),
+                         'mongo': args.mongo,
+                         'requests': args.requests,
+                         'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
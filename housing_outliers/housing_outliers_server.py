@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import json
 import hashlib
 import traceback
 import time
 import pickle
+import bisect
+import threading
+import collections
+import contextlib
 import jsonschema
 import pymongo
 import numpy as np
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from flask import Flask
+from flask import Response
+from flask import g
+from flask import has_request_context
 from flask import request
 from flask import make_response
 from flask import render_template
+from flask import stream_with_context
 
 # Machine learning libaries from scikit-learn
 from sklearn.preprocessing import LabelEncoder
@@ -41,96 +53,796 @@ housing_schema = {
         "floors": {"type": "number"},
         "date": {"type": "number"},
         "hash": {"type": "string"},
+        "predicted_price": {"type": "number"},
+        "residual": {"type": "number"},
     },
     "required": ["area","areacode","desc","type","size","price","year","floor","condition","rooms","city","floors"]
 }
 
+COLLECTIONS = ("apartments", "outliers")
+
+# histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics(object):
+    """In-process request metrics rendered in the Prometheus text format.
+    
+    Metrics are kept per process, each worker of a pre-forking server reports its own.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}   # (name, labels) -> [bucket counts..., sum, count]
+        self._counters = {}     # (name, labels) -> value
+        self._gauges = {}       # (name, labels) -> value
+        self._help = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[bucket] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def add_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+    
+    def describe(self, name, text):
+        self._help[name] = text
+    
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Time a phase of request handling, labelled with the route of the current request."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            route = request.url_rule.rule if has_request_context() and request.url_rule else "none"
+            self.observe("http_request_phase_seconds", time.time() - start_time, route=route, phase=phase)
+    
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = [(key, list(value)) for key, value in self._histograms.items()]
+            counters = self._counters.items()
+            gauges = self._gauges.items()
+        
+        lines = []
+        described = set()
+        def header(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append("# HELP %s %s" % (name, self._help[name]))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+        
+        for (name, labels), value in sorted(counters):
+            header(name, "counter")
+            lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        for (name, labels), value in sorted(gauges):
+            header(name, "gauge")
+            lines.append("%s%s %s" % (name, _format_labels(labels), value))
+        for (name, labels), histogram in sorted(histograms):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append("%s_bucket%s %i" % (name, _format_labels(labels + (("le", str(bound)),)), cumulative))
+            lines.append("%s_sum%s %f" % (name, _format_labels(labels), histogram[-2]))
+            lines.append("%s_count%s %i" % (name, _format_labels(labels), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+request_metrics = Metrics()
+request_metrics.describe("http_request_duration_seconds", "Request handling time by route, method and status.")
+request_metrics.describe("http_request_phase_seconds", "Time spent in phases of request handling by route.")
+request_metrics.describe("http_requests_in_flight", "Requests currently being handled.")
+request_metrics.describe("http_request_errors_total", "Requests answered with a 4xx or 5xx status.")
+
+# MongoClient options, see pymongo.MongoClient for details
+DEFAULT_CLIENT_OPTIONS = {
+    "maxPoolSize": 50,
+    "minPoolSize": 0,
+    "connectTimeoutMS": 2000,
+    "socketTimeoutMS": 10000,
+    "serverSelectionTimeoutMS": 5000,
+    "waitQueueTimeoutMS": 1000,
+}
+
+housing_validator = jsonschema.Draft4Validator(housing_schema)
+
+# lookup tables derived from housing_schema for validate_entry and hash_entry
+FIELD_TYPES = dict((field, spec['type']) for field, spec in housing_schema['properties'].items())
+REQUIRED_FIELDS = frozenset(housing_schema['required'])
+HASH_FIELDS = [field for field in housing_schema['required'] if field != "price"]
+
+def validate_entry(entry):
+    """Validate entry with the compiled housing_validator and encode its strings, in place.
+    
+    Fields not in the schema are removed from a valid entry. Returns
+    (True, entry) or (False, message).
+    """
+    if not housing_validator.is_valid(entry):
+        return False, _schema_error(entry)
+    
+    for field, value in entry.items():
+        field_type = FIELD_TYPES.get(field)
+        if field_type is None:
+            del entry[field]
+        elif field_type == "string":
+            if isinstance(value, unicode):
+                value = entry[field] = value.encode('utf-8')
+            if value == "" and field in REQUIRED_FIELDS:
+                return False, "Field '%s' is empty" % field
+    return True, entry
+
+def hash_entry(entry):
+    """Add date and hash to a validated entry, in place.
+    
+    The hash is the SHA-1 of the required fields except price, joined with
+    '.', so it matches the hashes of existing entries.
+    """
+    entry['date'] = time.time() * 1000
+    entry['hash'] = hashlib.sha1('.'.join([str(entry[field]) for field in HASH_FIELDS])).hexdigest()
+    return entry
+
+def _schema_error(entry):
+    error = jsonschema.exceptions.best_match(housing_validator.iter_errors(entry))
+    return "Input JSON doesn't match schema: " + (error.message if error is not None else "invalid entry")
+
+class CollectionCounts(object):
+    """Cached collection totals, incremented on inserts and reconciled with the database periodically.
+    
+    Inserts made by other processes show up at the next reconciliation.
+    """
+    
+    def __init__(self, db, reconcile_interval=60):
+        self.db = db
+        self.reconcile_interval = reconcile_interval
+        self._counts = {}       # collection -> (count, time of last reconciliation)
+        self._lock = threading.Lock()
+    
+    def get(self, collection):
+        with self._lock:
+            cached = self._counts.get(collection)
+        if cached is not None and time.time() - cached[1] < self.reconcile_interval:
+            return cached[0]
+        return self.reconcile(collection)
+    
+    def reconcile(self, collection):
+        """Replace the cached count with the database estimate."""
+        count = self.db.get_count(collection)
+        with self._lock:
+            self._counts[collection] = (count, time.time())
+        return count
+    
+    def increment(self, collection, count=1):
+        with self._lock:
+            if collection in self._counts:
+                cached, reconciled = self._counts[collection]
+                self._counts[collection] = (cached + count, reconciled)
+
 class DB():
-    def __init__(self):
-        pass
+    def __init__(self, host=None, client_factory=pymongo.MongoClient, **client_options):
+        """Database access with one pooled MongoClient per process.
+        
+        client_factory can be replaced with a compatible stand-in, for example
+        mongomock.MongoClient. client_options override DEFAULT_CLIENT_OPTIONS.
+        """
+        self.host = host
+        self.client_factory = client_factory
+        self.client_options = dict(DEFAULT_CLIENT_OPTIONS, **client_options)
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.counts = CollectionCounts(self)
+    
+    def client(self):
+        """Return the MongoClient of this process, created on first use and again after fork."""
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    # a client inherited from the parent process shares its sockets, it is left alone
+                    self._client = self.client_factory(self.host, **self.client_options)
+                    self._pid = pid
+        return self._client
+    
+    def close(self):
+        """Close the MongoClient of this process."""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+    
+    def _collection(self, collection):
+        if collection not in COLLECTIONS:
+            return None
+        return self.client().housing_outliers[collection]
+    
+    def ensure_indexes(self):
+        """Create the unique hash index used for deduplication and the date index used for sorting and paging."""
+        for collection in COLLECTIONS:
+            db = self._collection(collection)
+            db.create_index([('hash', pymongo.ASCENDING)], unique=True, name="hash_unique")
+            db.create_index([('date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)], name="date_id")
 
     def get(self, collection=None, count=1):
-        with pymongo.MongoClient() as client:
-            if collection == "apartments":
-                db = client.housing_outliers.apartments
-            elif collection == "outliers":
-                db = client.housing_outliers.outliers
-            else:
-                return []
-            
-            entries = []
+        db = self._collection(collection)
+        if db is None:
+            return []
+        
+        entries = []
+        with request_metrics.phase("mongo"):
             for entry in db.find().sort('date', pymongo.DESCENDING).limit(count):
                 entry['_id'] = str(entry['_id'])
                 if count == 1:
                     return entry
                 entries.append(entry)
-                
-            return entries
+            
+        return entries
 
-    def get_count(self, collection=None):
-        with pymongo.MongoClient() as client:
-            if collection == "apartments":
-                db = client.housing_outliers.apartments
-            elif collection == "outliers":
-                db = client.housing_outliers.outliers
+    def find_page(self, collection=None, count=1, after_date=None, after_id=None, fields=None, batch_size=500):
+        """Return a cursor over entries newest first, starting after the given date and _id.
+        
+        The date and _id of the last entry of a page are the cursor for the next one.
+        fields limits the returned fields, date and _id are always included.
+        """
+        db = self._collection(collection)
+        if db is None:
+            return None
+        
+        query = {}
+        if after_date is not None:
+            if after_id is None:
+                query = {'date': {'$lt': after_date}}
             else:
-                return 0
-            
-            count = db.count()
-            return count
+                query = {'$or': [{'date': {'$lt': after_date}},
+                                 {'date': after_date, '_id': {'$lt': after_id}}]}
+        projection = None
+        if fields is not None:
+            projection = dict((field, 1) for field in fields)
+            projection['date'] = 1
+        
+        cursor = db.find(query, projection).sort([('date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+        return cursor.limit(count).batch_size(batch_size)
+
+    def find_since(self, collection=None, after_date=None, after_id=None, before_date=None, batch_size=500):
+        """Return a cursor over entries oldest first, starting after the given date and _id.
+        
+        Entries sharing a date are ordered by _id like in find_page, so the date
+        and _id of the last entry seen resume the cursor. Entries dated after
+        before_date are left out.
+        """
+        db = self._collection(collection)
+        if db is None:
+            return None
+        
+        conditions = []
+        if after_date is not None:
+            if after_id is None:
+                conditions.append({'date': {'$gt': after_date}})
+            else:
+                conditions.append({'$or': [{'date': {'$gt': after_date}},
+                                           {'date': after_date, '_id': {'$gt': after_id}}]})
+        if before_date is not None:
+            conditions.append({'date': {'$lte': before_date}})
+        query = {'$and': conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+        cursor = db.find(query).sort([('date', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        return cursor.batch_size(batch_size)
+    
+    def get_watermark(self, job):
+        """Return the (date, _id) up to which a job has processed entries, (None, None) if never run."""
+        state = self.client().housing_outliers.jobs.find_one({'_id': job})
+        if state is None:
+            return None, None
+        watermark = state['watermark']
+        if not isinstance(watermark, dict):
+            # watermarks stored before the _id was kept are a bare date
+            return watermark, None
+        return watermark['date'], watermark['_id']
+    
+    def set_watermark(self, job, date, _id):
+        self.client().housing_outliers.jobs.update_one({'_id': job}, {'$set': {'watermark': {'date': date, '_id': _id}}},
+                                                       upsert=True)
+
+    def get_count(self, collection=None):
+        db = self._collection(collection)
+        if db is None:
+            return 0
+        
+        with request_metrics.phase("mongo"):
+            count = db.estimated_document_count()
+        return count
     
     def add(self, entry, collection=None):
-        with pymongo.MongoClient() as client:
-            if collection == "apartments":
-                db = client.housing_outliers.apartments
-            elif collection == "outliers":
-                db = client.housing_outliers.outliers
-            else:
-                return False, "Unknown collection %s" % collection
-            
-            # secondary check for required fields, for when entries are added directly instead of via web API
-            for required_field in housing_schema['required']:
-                if required_field not in entry:
-                    return False, "Missing required field '%s'" % required_field
-            
-            for field in entry.keys():
-                if housing_schema['properties'][field]['type'] == "string":
-                    if field in housing_schema['required'] and entry[field] == "":
-                        return False, "Field '%s' is empty" % field
-                    entry[field] = entry[field].encode('utf-8')
-            
-            str_to_hash = '.'.join(str(entry[field]) for field in housing_schema['required'] if field != "price")
-            entry_hash = hashlib.sha1()
-            entry_hash.update(str_to_hash)
-            
-            entry['date'] = time.time() * 1000
-            entry['hash'] = entry_hash.hexdigest()
+        db = self._collection(collection)
+        if db is None:
+            return False, "Unknown collection %s" % collection
+        
+        with request_metrics.phase("validate"):
+            result, ret = validate_entry(entry)
+        if not result:
+            return False, ret
+        with request_metrics.phase("hash"):
+            hash_entry(entry)
+        
+        # insert only if the hash is new, duplicates are reported by the write result
+        document = dict((field, value) for field, value in entry.items() if field != 'hash')
+        try:
+            with request_metrics.phase("mongo"):
+                result = db.update_one({'hash': entry['hash']}, {'$setOnInsert': document}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            # a concurrent upsert of the same entry won the race
+            return False, "Entry already exists"
+        
+        if result.upserted_id is not None:
+            self.counts.increment(collection)
+            return True, "Entry %s added to database." % entry['hash']
+        else:
+            return False, "Entry already exists"
+    
+    def add_many(self, entries, collection=None):
+        """Add a batch of entries with one duplicate query and one unordered insert.
+        
+        Returns a (result, message) tuple for each entry, in order.
+        """
+        db = self._collection(collection)
+        if db is None:
+            return [(False, "Unknown collection %s" % collection)] * len(entries)
+        
+        with request_metrics.phase("validate"):
+            results = [validate_entry(entry) for entry in entries]
+        with request_metrics.phase("hash"):
+            for entry, (result, ret) in zip(entries, results):
+                if result:
+                    hash_entry(entry)
+        hashes = set(entry['hash'] for entry, (result, ret) in zip(entries, results) if result)
+        with request_metrics.phase("mongo"):
+            existing = set(doc['hash'] for doc in db.find({'hash': {'$in': list(hashes)}}, {'hash': 1, '_id': 0}))
+        
+        documents = []
+        positions = []
+        for i, entry in enumerate(entries):
+            if not results[i][0]:
+                continue
+            if entry['hash'] in existing:
+                results[i] = (False, "Entry already exists")
+                continue
+            # later copies of the same entry within the batch are duplicates too
+            existing.add(entry['hash'])
+            documents.append(entry)
+            positions.append(i)
+        
+        if documents:
+            failed = {}
+            try:
+                with request_metrics.phase("mongo"):
+                    db.insert_many(documents, ordered=False)
+            except pymongo.errors.BulkWriteError, err:
+                for write_error in err.details['writeErrors']:
+                    failed[write_error['index']] = write_error
             
-            # check duplicates
-            exists = False
-            for entry in db.find({"hash": entry['hash']}):
-                exists = True
-                break
-                
-            if not exists:
-                db.insert_one(entry)
-                return True, "Entry %s added to database." % entry['hash']
-            else:
-                return False, "Entry already exists"
+            for index, i in enumerate(positions):
+                if index not in failed:
+                    results[i] = (True, "Entry %s added to database." % entries[i]['hash'])
+                elif failed[index]['code'] == 11000:
+                    # inserted concurrently since the duplicate query
+                    results[i] = (False, "Entry already exists")
+                else:
+                    results[i] = (False, "Insert failed: %s" % failed[index]['errmsg'])
+            self.counts.increment(collection, len(documents) - len(failed))
+        return results
+
+
+def stream_entries(entries, ndjson=False):
+    """Yield entries as a JSON array or as NDJSON, one entry at a time."""
+    if not ndjson:
+        yield '['
+    separator = ''
+    for entry in entries:
+        entry['_id'] = str(entry['_id'])
+        if ndjson:
+            yield json.dumps(entry) + '\n'
+        else:
+            yield separator + json.dumps(entry)
+            separator = ','
+    if not ndjson:
+        yield ']'
+
+def get_entries(collection):
+    """Return entries of collection for a GET request, streamed unless a single entry was requested."""
+    count = 1 if "count" not in request.args else int(request.args.get("count"))
+    ndjson = request.args.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", "")
+    fields = request.args.get("fields")
+    after_date = request.args.get("after_date")
+    after_id = request.args.get("after_id")
+    
+    if count == 1 and not ndjson and fields is None and after_date is None and after_id is None:
+        resp = make_response(json.dumps(db.get(collection=collection, count=count)), 200)
+        resp.headers['Content-Type'] = "application/json"
+        return resp
+    
+    try:
+        if fields is not None:
+            fields = fields.split(',')
+            for field in fields:
+                if field not in housing_schema['properties']:
+                    raise ValueError("Unknown field '%s'" % field)
+        if after_date is not None:
+            after_date = float(after_date)
+        if after_id is not None:
+            if after_date is None:
+                raise ValueError("after_id requires after_date")
+            after_id = ObjectId(after_id)
+    except (ValueError, InvalidId), err:
+        return make_response("Invalid parameter: " + str(err), 400)
+    
+    cursor = db.find_page(collection=collection, count=count, after_date=after_date, after_id=after_id, fields=fields)
+    return Response(stream_with_context(stream_entries(cursor, ndjson)),
+                    mimetype="application/x-ndjson" if ndjson else "application/json")
+
+def parse_bulk_input(content_type, data):
+    """Parse a JSON array or NDJSON request body into a list of (entry, error) tuples."""
+    if content_type == "application/json":
+        entries = json.loads(data)
+        if not isinstance(entries, list):
+            raise ValueError("Expected a JSON array")
+        return [(entry, None) for entry in entries]
+    
+    items = []
+    for line in data.splitlines():
+        if line.strip() == "":
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError, err:
+            items.append((None, "Invalid input JSON: " + str(err)))
+    return items
+
+def bulk_add(collection):
+    """Validate and add a bulk request body to collection, return response."""
+    content_type = request.headers.get("Content-Type", "").split(';')[0].strip()
+    if content_type not in ("application/json", "application/x-ndjson"):
+        return make_response("Invalid Content-Type, expected application/json or application/x-ndjson", 400)
+    
+    try:
+        with request_metrics.phase("json_parse"):
+            items = parse_bulk_input(content_type, request.data)
+    except ValueError, err:
+        return make_response("Invalid input JSON: " + str(err), 400)
+    
+    # entries are validated while they are normalized in add_many
+    results = [None] * len(items)
+    entries = []
+    positions = []
+    for i, (entry, error) in enumerate(items):
+        if error is not None:
+            results[i] = (False, error)
+        else:
+            entries.append(entry)
+            positions.append(i)
+    
+    for i, result in zip(positions, db.add_many(entries, collection=collection)):
+        results[i] = result
+    
+    resp = make_response(json.dumps({'added': sum(1 for result, ret in results if result),
+                                     'results': [{'index': i, 'result': result, 'message': ret}
+                                                 for i, (result, ret) in enumerate(results)]}), 200)
+    resp.headers['Content-Type'] = "application/json"
+    return resp
 
 
-db = DB()
+if os.environ.get("MONGODB_URI") == "mongomock":
+    # in-process stand-in for tests and benchmarks, data is lost on exit
+    import mongomock
+    db = DB(client_factory=lambda host, **options: mongomock.MongoClient())
+else:
+    db = DB(os.environ.get("MONGODB_URI"),
+            maxPoolSize=int(os.environ.get("MONGODB_MAX_POOL_SIZE", DEFAULT_CLIENT_OPTIONS["maxPoolSize"])))
+db.counts.reconcile_interval = float(os.environ.get("COUNTS_RECONCILE_INTERVAL", 60))
 app = Flask(__name__)
 
-with open('workflowdemo/model.dat', 'r') as f:
-    model = pickle.loads(f.read())
-predictor = model['predictor']
-areacode_le = model['areacode_encoder']
+@app.before_request
+def start_request_metrics():
+    g.request_start_time = time.time()
+    g.request_route = request.url_rule.rule if request.url_rule else "unknown"
+    request_metrics.add_gauge("http_requests_in_flight", 1, route=g.request_route)
+
+@app.after_request
+def record_request_metrics(response):
+    # streamed responses are timed until their first byte
+    request_metrics.observe("http_request_duration_seconds", time.time() - g.request_start_time,
+                    route=g.request_route, method=request.method, status=response.status_code)
+    if response.status_code >= 400:
+        request_metrics.inc("http_request_errors_total", route=g.request_route, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    if hasattr(g, "request_route"):
+        request_metrics.add_gauge("http_requests_in_flight", -1, route=g.request_route)
+
+try:
+    db.ensure_indexes()
+except pymongo.errors.PyMongoError, ex:
+    print "ERROR: Failed to create database indexes: " + traceback.format_exc()
+
+class LRUCache(object):
+    """Thread-safe LRU cache with per-entry TTL and hit, miss and eviction counters."""
+    
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()   # key -> (expires, value), least recently used first
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return cached value or None."""
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[key] = item
+            self.hits += 1
+            return item[1]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+MODEL_FILE = os.environ.get("MODEL_FILE", 'workflowdemo/model.dat')
+prediction_cache = LRUCache(maxsize=int(os.environ.get("PREDICTION_CACHE_SIZE", 10000)),
+                            ttl=float(os.environ.get("PREDICTION_CACHE_TTL", 3600)))
+
+class ModelNotLoaded(Exception):
+    pass
+
+class Model(object):
+    """Prediction model and the lookup tables derived from it."""
+    
+    def __init__(self, predictor, areacode_le, version):
+        self.predictor = predictor
+        self.areacode_le = areacode_le
+        self.version = version
+        # same codes as areacode_le.transform without its per-call overhead
+        self.areacode_index = dict((areacode, i) for i, areacode in enumerate(areacode_le.classes_))
+
+def read_model_file(model_file):
+    """Read a model dict from a pickle file, or from a joblib file with memory-mapped arrays.
+    
+    Workers that map the same .joblib file share the pages of its numpy arrays.
+    """
+    if model_file.endswith(".joblib"):
+        import joblib
+        return joblib.load(model_file, mmap_mode='r')
+    with open(model_file, 'rb') as f:
+        return pickle.load(f)
+
+def convert_model(model_file, joblib_file):
+    """Write a pickled model to an uncompressed joblib file that can be memory-mapped."""
+    import joblib
+    joblib.dump(read_model_file(model_file), joblib_file)
+
+class ModelLoader(object):
+    """Load the model in the background and reload it when the model file changes.
+    
+    A reload swaps the whole Model at once, requests keep using the model they
+    started with.
+    """
+    
+    def __init__(self, model_file, reload_interval=10, load_timeout=30):
+        self.model_file = model_file
+        self.reload_interval = reload_interval
+        self.load_timeout = load_timeout
+        self.model = None
+        self._mtime = None
+        self._version = 0
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+    
+    def start(self):
+        """Start the loader thread of this process, again after fork."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name="model-loader")
+            thread.daemon = True
+            thread.start()
+    
+    def get(self):
+        """Return the current model, waiting for the first load if needed."""
+        self.start()
+        if not self._loaded.wait(self.load_timeout) or self.model is None:
+            raise ModelNotLoaded("Model %s is not loaded" % self.model_file)
+        return self.model
+    
+    def load(self):
+        """Load the model file if it changed since the last load."""
+        mtime = os.path.getmtime(self.model_file)
+        if mtime == self._mtime:
+            return False
+        model = read_model_file(self.model_file)
+        self._version += 1
+        self.model = Model(model['predictor'], model['areacode_encoder'], self._version)
+        self._mtime = mtime
+        self._loaded.set()
+        # cached predictions are keyed by model version, old ones can only be evicted
+        prediction_cache.clear()
+        return True
+    
+    def _run(self):
+        while True:
+            try:
+                if self.load():
+                    print "Loaded model %s (version %i)" % (self.model_file, self._version)
+            except Exception, ex:
+                # keep serving the previous model
+                print "ERROR: Failed to load model %s: %s" % (self.model_file, traceback.format_exc())
+            if self.reload_interval <= 0:
+                break
+            time.sleep(self.reload_interval)
+
+model_loader = ModelLoader(MODEL_FILE,
+                           reload_interval=float(os.environ.get("MODEL_RELOAD_INTERVAL", 10)),
+                           load_timeout=float(os.environ.get("MODEL_LOAD_TIMEOUT", 30)))
+model_loader.start()
+
+# model input features, in column order
+FEATURES = ("areacode", "size", "year", "elevator", "condition", "floor", "floors")
+
+def encode_features(item, model):
+    """Encode a dict of FEATURES into a row of floats, raise ValueError for invalid input."""
+    row = []
+    for feature in FEATURES:
+        value = item.get(feature)
+        if value is None:
+            raise ValueError("Missing feature '%s'" % feature)
+        if feature == "areacode":
+            if value not in model.areacode_index:
+                raise ValueError("Unknown areacode '%s'" % value)
+            value = model.areacode_index[value]
+        try:
+            row.append(float(value))
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value for feature '%s': %r" % (feature, value))
+    return row
+
+# set by alternative serving modes to run model inference outside the request handling thread,
+# any object with a ThreadPool-like apply(func, args) method
+inference_pool = None
+
+def run_inference(model, features):
+    """Run model prediction on a feature matrix, in inference_pool if one is set."""
+    with request_metrics.phase("predict"):
+        if inference_pool is None:
+            return model.predictor.predict(features)
+        return inference_pool.apply(model.predictor.predict, (features,))
+
+def predict_prices(rows, model):
+    """Predict prices for encoded feature rows, scoring cache misses with a single model call."""
+    keys = [(model.version,) + tuple(row) for row in rows]
+    prices = [prediction_cache.get(key) for key in keys]
+    missing = [i for i, price in enumerate(prices) if price is None]
+    if missing:
+        features = np.array([rows[i] for i in missing], dtype=float)
+        for i, price in zip(missing, run_inference(model, features)):
+            prices[i] = float(price)
+            prediction_cache.put(keys[i], prices[i])
+    return prices
+
+OUTLIER_THRESHOLD = float(os.environ.get("OUTLIER_THRESHOLD", 0.3))
+# entries are dated before they are written, only those older than this many seconds are scored
+OUTLIER_WATERMARK_MARGIN = float(os.environ.get("OUTLIER_WATERMARK_MARGIN", 60))
+outlier_detection_lock = threading.Lock()
+
+def detect_outliers(threshold=OUTLIER_THRESHOLD, chunk_size=1000):
+    """Add apartments whose price deviates from the predicted price by more than threshold to outliers.
+    
+    Only apartments added since the previous run are scored, in chunks of
+    chunk_size. Apartments dated within OUTLIER_WATERMARK_MARGIN seconds of
+    now are left for the next run, an insert still in flight may carry an
+    older date than ones already written. The residual is relative to the
+    predicted price. Returns a summary dict.
+    """
+    with outlier_detection_lock:
+        model = model_loader.get()
+        after_date, after_id = db.get_watermark("outlier_detection")
+        before_date = (time.time() - OUTLIER_WATERMARK_MARGIN) * 1000
+        summary = {'processed': 0, 'skipped': 0, 'flagged': 0, 'added': 0,
+                   'watermark': {'date': after_date, 'id': None if after_id is None else str(after_id)}}
+        
+        chunk = []
+        for entry in db.find_since("apartments", after_date=after_date, after_id=after_id, before_date=before_date,
+                                   batch_size=chunk_size):
+            chunk.append(entry)
+            if len(chunk) == chunk_size:
+                _detect_outliers_chunk(chunk, model, threshold, summary)
+                chunk = []
+        if chunk:
+            _detect_outliers_chunk(chunk, model, threshold, summary)
+        return summary
+
+def _detect_outliers_chunk(entries, model, threshold, summary):
+    rows = []
+    scored = []
+    for entry in entries:
+        try:
+            rows.append(encode_features(entry, model))
+            scored.append(entry)
+        except ValueError:
+            summary['skipped'] += 1
+    
+    if scored:
+        prices = np.array([entry['price'] for entry in scored], dtype=float)
+        predicted = np.array(run_inference(model, np.array(rows, dtype=float)), dtype=float)
+        # a residual relative to a price that is not positive means nothing, those rows are skipped
+        positive = predicted > 0
+        summary['skipped'] += int(np.count_nonzero(~positive))
+        residuals = (prices - predicted) / np.where(positive, predicted, 1.0)
+        
+        outliers = []
+        for entry, predicted_price, residual, is_positive in zip(scored, predicted, residuals, positive):
+            if is_positive and abs(residual) > threshold:
+                outlier = dict((field, value) for field, value in entry.items() if field not in ('_id', 'date', 'hash'))
+                outlier['predicted_price'] = float(predicted_price)
+                outlier['residual'] = float(residual)
+                outliers.append(outlier)
+        if outliers:
+            summary['flagged'] += len(outliers)
+            summary['added'] += sum(1 for result, ret in db.add_many(outliers, collection="outliers") if result)
+    
+    # the watermark only moves forward once the chunk is written
+    summary['processed'] += len(entries)
+    last = entries[-1]
+    summary['watermark'] = {'date': last['date'], 'id': str(last['_id'])}
+    db.set_watermark("outlier_detection", last['date'], last['_id'])
 
 
 @app.route("/")
 def index():
-    return render_template("index.html", apartments_count=db.get_count("apartments"), outliers_count=db.get_count("outliers"))
+    return render_template("index.html", apartments_count=db.counts.get("apartments"), outliers_count=db.counts.get("outliers"))
     
 @app.route('/price/area/<int:area>/size/<int:size>', methods=["GET"])
 def price_api(area,size):
@@ -149,25 +861,19 @@ def price_api(area,size):
 def apartments_api():
     try:
         if request.method == "GET":     
-            count = 1 if "count" not in request.args else int(request.args.get("count"))
-            
-            resp = make_response(json.dumps(db.get(collection="apartments", count=count)), 200)
-            
-            resp.headers['Content-Type'] = "application/json"
-            return resp
+            return get_entries("apartments")
             
         elif request.method == "POST":        
             if request.headers.get("Content-Type") != "application/json":
                 return make_response("Invalid Content-Type, expected application/json", 400)
                 
             try:
-                input_data = json.loads(request.data)
-                jsonschema.validate(input_data, housing_schema)
+                with request_metrics.phase("json_parse"):
+                    input_data = json.loads(request.data)
             except ValueError, err:
                 return make_response("Invalid input JSON: " + str(err), 400)
-            except jsonschema.exceptions.ValidationError, err:
-                return make_response("Input JSON doesn't match schema: " + str(err), 400)
-                            
+            
+            # validated while normalized in db.add
             result, ret = db.add(input_data, collection="apartments")
             code = 200 if result else 400
 
@@ -183,24 +889,19 @@ def apartments_api():
 def outliers_api():
     try:
         if request.method == "GET":            
-            count = 1 if "count" not in request.args else int(request.args.get("count"))
-            
-            resp = make_response(json.dumps(db.get(collection="outliers", count=count)), 200)
-            resp.headers['Content-Type'] = "application/json"
-            return resp
+            return get_entries("outliers")
             
         elif request.method == "POST":        
             if request.headers.get("Content-Type") != "application/json":
                 return make_response("Invalid Content-Type, expected application/json", 400)
                 
             try:
-                input_data = json.loads(request.data)
-                jsonschema.validate(input_data, housing_schema)
+                with request_metrics.phase("json_parse"):
+                    input_data = json.loads(request.data)
             except ValueError, err:
                 return make_response("Invalid input JSON: " + str(err), 400)
-            except jsonschema.exceptions.ValidationError, err:
-                return make_response("Input JSON doesn't match schema: " + str(err), 400)
-                            
+            
+            # validated while normalized in db.add
             result, ret = db.add(input_data, collection="outliers")
             code = 200 if result else 400
 
@@ -213,29 +914,124 @@ def outliers_api():
         return make_response(err, 500)
         
 
+@app.route('/apartments/bulk', methods=["POST"])
+def apartments_bulk_api():
+    try:
+        return bulk_add("apartments")
+    except Exception, ex:
+        err = "ERROR: " + traceback.format_exc()
+        print err
+        return make_response(err, 500)
+
+@app.route('/outliers/bulk', methods=["POST"])
+def outliers_bulk_api():
+    try:
+        return bulk_add("outliers")
+    except Exception, ex:
+        err = "ERROR: " + traceback.format_exc()
+        print err
+        return make_response(err, 500)
+
+@app.route('/outliers/detect', methods=["POST"])
+def outliers_detect_api():
+    try:
+        try:
+            threshold = float(request.args.get("threshold", OUTLIER_THRESHOLD))
+            if not threshold >= 0:
+                raise ValueError("threshold must be a non-negative number")
+        except ValueError, err:
+            return make_response("Invalid parameter: " + str(err), 400)
+        resp = make_response(json.dumps(detect_outliers(threshold=threshold)), 200)
+        resp.headers['Content-Type'] = "application/json"
+        return resp
+    except ModelNotLoaded, ex:
+        return make_response(str(ex), 503)
+    except Exception, ex:
+        err = "ERROR: " + traceback.format_exc()
+        print err
+        return make_response(err, 500)
+
+@app.route('/metrics', methods=["GET"])
+def metrics_api():
+    resp = make_response(request_metrics.render(), 200)
+    resp.headers['Content-Type'] = "text/plain; version=0.0.4"
+    return resp
+
 @app.route('/predict', methods=["GET"])
 def predict_api():
     try:
        if request.method == "GET":
-            areacode = request.args.get("areacode")
-            year = request.args.get("year")
-            size = request.args.get("size")
-            elevator = request.args.get("elevator")
-            condition = request.args.get("condition")
-            floor = request.args.get("floor")
-            floors = request.args.get("floors")
-
-            areacode = areacode_le.transform([areacode])[0]
-            feature = np.array([areacode,size,year,elevator,condition,floor,floors])
-            price = predictor.predict(feature.reshape(1,-1))
+            model = model_loader.get()
+            price = predict_prices([encode_features(request.args, model)], model)
            
             resp = make_response(json.dumps({'price' : price[0]}), 200)
             resp.headers['Content-Type'] = "application/json"
             resp.headers['Access-Control-Allow-Origin'] = '*'
             return resp
 
+    except ModelNotLoaded, ex:
+        return make_response(str(ex), 503)
+    except Exception, ex:
+        err = "ERROR: " + traceback.format_exc()
+        print err
+        return make_response(err, 500)
+
+@app.route('/predict/cache', methods=["GET"])
+def predict_cache_api():
+    resp = make_response(json.dumps(prediction_cache.stats()), 200)
+    resp.headers['Content-Type'] = "application/json"
+    return resp
+
+@app.route('/predict/batch', methods=["POST"])
+def predict_batch_api():
+    try:
+        content_type = request.headers.get("Content-Type", "").split(';')[0].strip()
+        if content_type not in ("application/json", "application/x-ndjson"):
+            return make_response("Invalid Content-Type, expected application/json or application/x-ndjson", 400)
+        
+        try:
+            with request_metrics.phase("json_parse"):
+                items = parse_bulk_input(content_type, request.data)
+        except ValueError, err:
+            return make_response("Invalid input JSON: " + str(err), 400)
+        
+        model = model_loader.get()
+        results = [None] * len(items)
+        rows = []
+        positions = []
+        for i, (item, error) in enumerate(items):
+            if error is None:
+                try:
+                    if not isinstance(item, dict):
+                        raise ValueError("Expected a JSON object")
+                    rows.append(encode_features(item, model))
+                    positions.append(i)
+                    continue
+                except ValueError, err:
+                    error = str(err)
+            results[i] = {'index': i, 'error': error}
+        
+        for i, price in zip(positions, predict_prices(rows, model)):
+            results[i] = {'index': i, 'price': price}
+        
+        resp = make_response(json.dumps({'results': results}), 200)
+        resp.headers['Content-Type'] = "application/json"
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        return resp
+
+    except ModelNotLoaded, ex:
+        return make_response(str(ex), 503)
     except Exception, ex:
         err = "ERROR: " + traceback.format_exc()
         print err
         return make_response(err, 500)
         
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "detect-outliers":
+        # batch job, e.g. from cron: python housing_outliers_server.py detect-outliers [threshold]
+        threshold = float(sys.argv[2]) if len(sys.argv) > 2 else OUTLIER_THRESHOLD
+        print json.dumps(detect_outliers(threshold=threshold))
+    else:
+        app.run(port=int(os.environ.get("PORT", 5000)), threaded=True)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+import mongomock
+
+import housing_outliers_loadtest as loadtest
+from housing_outliers_ingest_benchmark import legacy_prepare
+
+# the server module connects and loads its model on import
+tmpdir = tempfile.mkdtemp()
+model_file = os.path.join(tmpdir, "model.dat")
+loadtest.write_synthetic_model(model_file)
+os.environ.update({'MONGODB_URI': 'mongomock', 'MODEL_FILE': model_file, 'MODEL_RELOAD_INTERVAL': '0'})
+import housing_outliers_server as server
+
+def tearDownModule():
+    shutil.rmtree(tmpdir)
+
+class TestHousingOutliers(unittest.TestCase):
+
+    def setUp(self):
+        server.db = server.DB(client_factory=lambda host, **options: mongomock.MongoClient())
+        server.db.ensure_indexes()
+        self.client = server.app.test_client()
+        rng = random.Random(0)
+        self.apartments = [loadtest.synthetic_apartment(rng, i) for i in range(10)]
+
+    def post_bulk(self, data, content_type="application/json"):
+        resp = self.client.post('/apartments/bulk', data=data, content_type=content_type)
+        self.assertEquals(resp.status_code, 200)
+        return json.loads(resp.data)
+
+    def test_add_many_results(self):
+        server.db.add_many([dict(self.apartments[0])], collection="apartments")
+        entries = [dict(self.apartments[0]), dict(self.apartments[1]), {'area': "Kallio"},
+                   dict(self.apartments[1]), dict(self.apartments[2], desc=""), dict(self.apartments[2])]
+        results = server.db.add_many(entries, collection="apartments")
+        self.assertEquals([result for result, message in results], [False, True, False, False, False, True])
+        self.assertEquals(results[0][1], "Entry already exists")
+        self.assertIn("doesn't match schema", results[2][1])
+        self.assertEquals(results[3][1], "Entry already exists")
+        self.assertEquals(results[4][1], "Field 'desc' is empty")
+        self.assertEquals(server.db.get_count("apartments"), 3)
+
+    def test_add_many_concurrent_duplicate(self):
+        # entries inserted by another request after the duplicate query fail the unique index
+        server.db.add(dict(self.apartments[1]), collection="apartments")
+        collection = server.db._collection("apartments")
+        find = collection.find
+        collection.find = lambda query, *args, **kwargs: find({'hash': None}, *args, **kwargs)
+        results = server.db.add_many([dict(self.apartments[0]), dict(self.apartments[1]), dict(self.apartments[2])],
+                                     collection="apartments")
+        self.assertEquals([result for result, message in results], [True, False, True])
+        self.assertEquals(results[1][1], "Entry already exists")
+
+    def test_add_drops_unknown_fields(self):
+        result, message = server.db.add(dict(self.apartments[0], junk=1, **{'$set': 2}), collection="apartments")
+        self.assertTrue(result, message)
+        entry = server.db._collection("apartments").find_one()
+        self.assertNotIn('junk', entry)
+        self.assertNotIn('$set', entry)
+
+    def test_bulk_ndjson(self):
+        lines = [json.dumps(self.apartments[0]), "", "not json", json.dumps({'area': "Kallio"}),
+                 json.dumps(self.apartments[0]), json.dumps(self.apartments[1])]
+        body = self.post_bulk("\n".join(lines) + "\n", "application/x-ndjson")
+        self.assertEquals(body['added'], 2)
+        self.assertEquals([(item['index'], item['result']) for item in body['results']],
+                          [(0, True), (1, False), (2, False), (3, False), (4, True)])
+        self.assertIn("Invalid input JSON", body['results'][1]['message'])
+        self.assertEquals(body['results'][3]['message'], "Entry already exists")
+
+    def test_bulk_rejects_non_array(self):
+        resp = self.client.post('/apartments/bulk', data=json.dumps(self.apartments[0]), content_type="application/json")
+        self.assertEquals(resp.status_code, 400)
+
+    def test_hash_matches_legacy(self):
+        entries = [json.loads(json.dumps(apartment)) for apartment in self.apartments]
+        entries[0]['area'] = u"Töölö"
+        for entry in entries:
+            legacy_ok, legacy_entry = legacy_prepare(copy.deepcopy(entry), server.housing_schema)
+            result, entry = server.validate_entry(entry)
+            self.assertTrue(legacy_ok and result)
+            self.assertEquals(server.hash_entry(entry)['hash'], legacy_entry['hash'])
+
+    def test_paging_across_equal_dates(self):
+        server.db.add_many(self.apartments, collection="apartments")
+        collection = server.db._collection("apartments")
+        collection.update_many({}, {'$set': {'date': 1000.0}})
+
+        seen = []
+        args = {'count': 3, 'fields': "area"}
+        while True:
+            page = json.loads(self.client.get('/apartments', query_string=args).data)
+            if not page:
+                break
+            seen.extend(entry['_id'] for entry in page)
+            args.update(after_date=repr(page[-1]['date']), after_id=page[-1]['_id'])
+        self.assertEquals(sorted(seen), sorted(str(entry['_id']) for entry in collection.find()))
+
+    def test_paging_rejects_after_id_without_after_date(self):
+        server.db.add_many(self.apartments, collection="apartments")
+        after_id = str(server.db._collection("apartments").find_one()['_id'])
+        for count in (1, 3):
+            resp = self.client.get('/apartments', query_string={'count': count, 'after_id': after_id})
+            self.assertEquals(resp.status_code, 400)
+
+    def test_detect_outliers_skips_non_positive_predictions(self):
+        server.db.add_many(self.apartments[:4], collection="apartments")
+        server.db._collection("apartments").update_many({}, {'$set': {'date': 1000.0}})
+        prices = [apartment['price'] for apartment in self.apartments[:4]]
+        run_inference = server.run_inference
+        server.run_inference = lambda model, features: [prices[0] * 2, 0.0, -prices[2], prices[3]]
+        try:
+            summary = server.detect_outliers(threshold=0.3)
+        finally:
+            server.run_inference = run_inference
+        self.assertEquals((summary['processed'], summary['skipped'], summary['added']), (4, 2, 1))
+        resp = self.client.get('/outliers', query_string={'count': 5})
+        self.assertEquals([outlier['residual'] for outlier in json.loads(resp.data)], [-0.5])
+
+    def test_detect_outliers_rejects_bad_threshold(self):
+        for threshold in ("high", "-1", "nan"):
+            resp = self.client.post('/outliers/detect', query_string={'threshold': threshold})
+            self.assertEquals(resp.status_code, 400)
+
+if __name__ == "__main__":
+    unittest.main()
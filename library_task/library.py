@@ -1,70 +1,683 @@
 import sys
 import os
+import bisect
+import heapq
+import mmap
+import re
+import shutil
+import tempfile
+from array import array
+from collections import Mapping, Sequence
+
+ROW_FORMAT = "%-{maxlen}s%-{maxlen}s%-{maxlen}s\n".format(maxlen=30)
+SORT_CHUNK_SIZE = 100000   # rows held in memory at a time by sort_library_file
 
 class Library():
     """Object representation of a library database."""
     
-    def __init__(self, library_file=None):
+    def __init__(self, library_file=None, compact_every=1000, mapped=False):
         self.library_file = library_file
-        self.books = []
+        self.journal_file = None if library_file is None else library_file + ".journal"
+        self.sorted_file = None if library_file is None else library_file + ".sorted"
+        self.compact_every = compact_every
+        self.mapped = mapped
+        self.books = []          # in mapped mode only the books not yet compacted into the snapshot
+        self._mapped = None      # memory-mapped snapshot, see MappedBooks
+        self._unsaved = []       # books added since the last save
+        self._journal_rows = 0   # books appended to the journal since the last compaction
+        self._authors = []       # sort keys of self.books, kept in the same order
+        self._index = {}         # (title, author) -> book, for duplicate checks
+        self._titles = {}        # title -> first book with that title in author order
+        self._search = SearchIndex()     # search index of self.books, kept up to date
+        self._mapped_search = None   # search index of the mapped snapshot, built on first search
     
-    def read_library(self):
-        """Read library contents from a file on disk."""
-        with open(self.library_file, 'r') as f:
-            library_content = f.readlines()
+    def read_library(self, chunk_size=None):
+        """Read library contents from a file on disk, return list of malformed rows.
+        
+        In mapped mode the file is memory-mapped instead of loaded. For a file that
+        is not sorted by author, a sorted copy is written to sorted_file with an
+        external merge sort holding chunk_size rows in memory at a time, and the
+        copy is mapped instead. The library file itself is left unchanged.
+        
+        Otherwise all books are loaded into memory. chunk_size then only bounds
+        the memory used for sorting, not for holding the books.
+        """
+        if self.mapped:
+            self.books = []
+            self._authors = []
+            self._index = {}
+            self._titles = {}
+            self._search = SearchIndex()
+            self._mapped_search = None
+            self._mapped, errors = MappedBooks.open(self.library_file)
+            if self._mapped is None:
+                errors = self._write_snapshot(lambda f: sort_library_file(self.library_file, f,
+                                                                          chunk_size or SORT_CHUNK_SIZE),
+                                              self.sorted_file)
+                self._mapped, _ = MappedBooks.open(self.sorted_file)
+        elif chunk_size is None:
+            with open(self.library_file, 'r') as f:
+                errors = self.load_books(f)
+        else:
+            with tempfile.TemporaryFile() as sorted_file:
+                errors = sort_library_file(self.library_file, sorted_file, chunk_size)
+                sorted_file.seek(0)
+                self.load_books(sorted_file)
+        
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r+') as f:
+                rows = _JournalReader(f)
+                for line_number, err in self.load_books(rows):
+                    errors.append((line_number, "%s (in journal)" % err))
+                self._journal_rows = rows.count
+                # cut off a torn last row, the next save would otherwise append to it
+                if rows.size < os.fstat(f.fileno()).st_size:
+                    f.truncate(rows.size)
+        return errors
     
-        for row in library_content:
-            fields = row.split('\t')
-            self.add_book(fields[1].strip(), fields[0].strip(), fields[2].strip())
+    def load_books(self, rows):
+        """Bulk load rows in library file format, return list of malformed rows.
         
-        self.sort_books()
+        Duplicates are skipped and the books are sorted and added to the
+        search index once after loading.
+        Malformed rows are reported as (line number, error) tuples.
+        """
+        errors = []
+        loaded = []
+        for line_number, row in enumerate(rows, 1):
+            if row.strip() == "":
+                continue
+            try:
+                title, author, isbn = parse_row(row)
+            except ValueError, err:
+                errors.append((line_number, str(err)))
+                continue
+            
+            if self._contains(title, author):
+                continue
+            book = {'author': author, 'title': title, 'isbn': isbn}
+            self.books.append(book)
+            self._index_book(book)
+            loaded.append(book)
+        
+        if loaded:
+            self.books.sort(key=lambda k: k['author'])
+            self._authors = [book['author'] for book in self.books]
+            self._search.add_many(loaded)
+        return errors
     
     def add_book(self, author, title, isbn):
         """Add book to database, check for duplicates."""
-        for book in self.books:
-            if book['title'] == title and book['author'] == author:
-                return False
-            
-        self.books.append({'author': author, 'title': title, 'isbn': isbn})
-        self.sort_books()
+        if self._contains(title, author):
+            return False
+        
+        book = {'author': author, 'title': title, 'isbn': isbn}
+        # insert after existing books by the same author to keep the sort stable
+        position = bisect.bisect_right(self._authors, author)
+        self._authors.insert(position, author)
+        self.books.insert(position, book)
+        self._index_book(book)
+        self._search.add(book)
+        self._unsaved.append(book)
         return True
+    
+    def _contains(self, title, author):
+        """Check whether a book is already in the database."""
+        if (title, author) in self._index:
+            return True
+        return self._mapped is not None and self._mapped.contains(title, author)
+    
+    def _index_book(self, book):
+        """Add book to the duplicate and title lookup indexes."""
+        self._index[(book['title'], book['author'])] = book
+        first = self._titles.get(book['title'])
+        if first is None or book['author'] < first['author']:
+            self._titles[book['title']] = book
         
     def get_books(self):
         """Return all books in database."""
-        return self.books
+        if self._mapped is None:
+            return self.books
+        return MergedBooks(self._mapped, self.books, self._authors)
         
     def get_book(self, title):
         """Find a book by title and return it."""
-        for book in self.books:
-            if book['title'] == title:
-                return book
-        return None
+        book = self._titles.get(title)
+        if self._mapped is not None:
+            mapped_book = self._mapped.find_title(title)
+            if book is None or (mapped_book is not None and mapped_book['author'] < book['author']):
+                return mapped_book
+        return book
+    
+    def search(self, query, limit=None):
+        """Find books whose title or author contain all words of the query, in author order."""
+        return self._search_indexes('search', query, limit)
+    
+    def search_prefix(self, prefix, limit=None):
+        """Find books whose title or author start with prefix, in author order."""
+        return self._search_indexes('prefix', prefix, limit)
+    
+    def _search_indexes(self, method, query, limit):
+        books = getattr(self._search, method)(query)
+        if self._mapped is not None:
+            if self._mapped_search is None:
+                self._mapped_search = SearchIndex()
+                self._mapped_search.add_many(self._mapped)
+            books.extend(getattr(self._mapped_search, method)(query))
+        books.sort(key=lambda k: (k['author'], k['title']))
+        return books if limit is None else books[:limit]
     
     def sort_books(self):
-        """Sort books by author."""
+        """Sort books by author and rebuild the lookup indexes."""
         self.books = sorted(self.books, key=lambda k: k['author'])
+        self._authors = [book['author'] for book in self.books]
+        self._index = {}
+        self._titles = {}
+        for book in self.books:
+            self._index_book(book)
+        self._search = SearchIndex()
+        self._search.add_many(self.books)
 
     def list_books(self):
         """Return formatted table of all books in database."""
-        row_maxlen = 30
-        output = ""
+        return "".join(self.render_books())
+    
+    def render_books(self, offset=0, limit=None, authors=None, titles=None, header=True):
+        """Yield formatted table rows of books in database.
         
-        title_row = "%-{maxlen}s%-{maxlen}s%-{maxlen}s\n".format(maxlen=row_maxlen) % ("Title", "Author", "ISBN")
-        output += title_row
-        output += "".join(["-" for i in range(len(title_row))]) + '\n'
+        authors and titles are optional (first, last) ranges to filter by, either end
+        may be None. offset and limit apply to the filtered books.
+        """
+        if header:
+            yield _table_header()
         
-        for book in self.books:
-            output += "%-{maxlen}s%-{maxlen}s%-{maxlen}s\n".format(maxlen=row_maxlen) % (book['title'], book['author'], book['isbn'])
-            
-        return output
+        first_author, last_author = authors or (None, None)
+        first_title, last_title = titles or (None, None)
+        books = self.get_books()
+        start = 0 if first_author is None else self._bisect_author(first_author)
+        for i in xrange(start, len(books)):
+            if limit is not None and limit <= 0:
+                break
+            book = books[i]
+            if last_author is not None and book['author'] > last_author:
+                break
+            if first_title is not None and book['title'] < first_title:
+                continue
+            if last_title is not None and book['title'] > last_title:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            if limit is not None:
+                limit -= 1
+            yield ROW_FORMAT % (book['title'], book['author'], book['isbn'])
+    
+    def render_pages(self, page_size=50, **filters):
+        """Yield formatted table pages of page_size books, see render_books for filters."""
+        page = []
+        for row in self.render_books(header=False, **filters):
+            page.append(row)
+            if len(page) == page_size:
+                yield _table_header() + "".join(page)
+                page = []
+        if page:
+            yield _table_header() + "".join(page)
+    
+    def _bisect_author(self, author):
+        """Return the index of the first book by author or later in get_books order."""
+        position = bisect.bisect_left(self._authors, author)
+        if self._mapped is not None:
+            position += self._mapped._bisect_author(author)
+        return position
             
     def save(self):
-        """Serialize books database to disk."""
-        with open(self.library_file, 'w') as f:
-            for book in self.books:
-                f.write("%s\t%s\t%s\n" % (book['title'], book['author'], book['isbn']))
+        """Append books added since the last save to the journal on disk.
+        
+        All unsaved books are written and synced at once. The journal is compacted
+        into the library file when it grows past compact_every books.
+        """
+        if self._unsaved:
+            with open(self.journal_file, 'a') as f:
+                f.write("".join(_format_row(book) for book in self._unsaved))
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_rows += len(self._unsaved)
+            self._unsaved = []
+        
+        if self._journal_rows >= self.compact_every:
+            self.compact()
+    
+    def compact(self):
+        """Serialize books database to disk and truncate the journal.
+        
+        The library file is replaced atomically, see _write_snapshot. The row
+        offsets and title order of the new file are written to an index file next
+        to it, so that it can be mapped without reading it.
+        """
+        offsets = array('L')
+        titles = []
+        
+        def write(f):
+            position = 0
+            for book in self.get_books():
+                row = _format_row(book)
+                f.write(row)
+                offsets.append(position)
+                titles.append(book['title'])
+                position += len(row)
+        self._write_snapshot(write)
+        _write_index(self.library_file, offsets, _title_order(titles))
+        
+        # a crash before the journal is removed is harmless, replaying it only finds duplicates
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+        # the library file is sorted now and mapped directly
+        if os.path.exists(self.sorted_file):
+            os.remove(self.sorted_file)
+        self._unsaved = []
+        self._journal_rows = 0
+        
+        if self.mapped:
+            self.read_library()
+    
+    def _write_snapshot(self, write, snapshot_file=None):
+        """Replace snapshot_file with the rows write(f) writes to f, return what write returns.
+        
+        snapshot_file defaults to the library file. The rows are written to a
+        temporary file in the same directory, which is synced and renamed over
+        snapshot_file.
+        """
+        snapshot_file = snapshot_file or self.library_file
+        directory, filename = os.path.split(os.path.abspath(snapshot_file))
+        fd, tmp_file = tempfile.mkstemp(prefix="." + filename, dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                ret = write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.library_file):
+                shutil.copymode(self.library_file, tmp_file)
+            os.rename(tmp_file, snapshot_file)
+        except:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return ret
+    
+    def close(self):
+        """Save unsaved books and compact the journal, if any."""
+        self.save()
+        if self._journal_rows > 0:
+            self.compact()
 
 
+class SearchIndex(object):
+    """Prefix and full-text index over book titles and authors, updated incrementally."""
+    
+    def __init__(self):
+        self._keys = []       # lowercase titles and authors, sorted
+        self._key_books = []  # book of each key in self._keys
+        self._words = {}      # word -> list of books containing it
+    
+    def add(self, book):
+        """Add book to the index."""
+        for key in (book['title'].lower(), book['author'].lower()):
+            position = bisect.bisect_right(self._keys, key)
+            self._keys.insert(position, key)
+            self._key_books.insert(position, book)
+        self._add_words(book)
+    
+    def add_many(self, books):
+        """Add books to the index, sorting the prefix keys once."""
+        keys = zip(self._keys, self._key_books)
+        for book in books:
+            keys.append((book['title'].lower(), book))
+            keys.append((book['author'].lower(), book))
+            self._add_words(book)
+        keys.sort(key=lambda k: k[0])
+        self._keys = [key for key, book in keys]
+        self._key_books = [book for key, book in keys]
+    
+    def _add_words(self, book):
+        for word in set(_words(book['title'] + ' ' + book['author'])):
+            self._words.setdefault(word, []).append(book)
+    
+    def prefix(self, prefix):
+        """Return books whose title or author start with prefix."""
+        prefix = prefix.lower()
+        books = {}
+        for i in xrange(bisect.bisect_left(self._keys, prefix), len(self._keys)):
+            if not self._keys[i].startswith(prefix):
+                break
+            books[id(self._key_books[i])] = self._key_books[i]
+        return books.values()
+    
+    def search(self, query):
+        """Return books whose title or author contain all words of the query."""
+        postings = [self._words.get(word, []) for word in set(_words(query))]
+        if not postings:
+            return []
+        postings.sort(key=len)
+        others = [set(id(book) for book in posting) for posting in postings[1:]]
+        return [book for book in postings[0] if all(id(book) in other for other in others)]
+
+WORD_RE = re.compile(r'\w+')
+
+def _words(text):
+    """Split text into lowercase words for the full-text index."""
+    return WORD_RE.findall(text.lower())
+
+class BookView(Mapping):
+    """Read-only dict-like view of a book row in a memory-mapped library file."""
+    
+    __slots__ = ('_mm', '_offset')
+    FIELDS = ('title', 'author', 'isbn')
+    
+    def __init__(self, mm, offset):
+        self._mm = mm
+        self._offset = offset
+    
+    def __getitem__(self, key):
+        try:
+            field = self.FIELDS.index(key)
+        except ValueError:
+            raise KeyError(key)
+        return _read_row(self._mm, self._offset)[field]
+    
+    def __iter__(self):
+        return iter(self.FIELDS)
+    
+    def __len__(self):
+        return len(self.FIELDS)
+    
+    def __repr__(self):
+        return repr(dict(self))
+
+class MappedBooks(Sequence):
+    """Author-sorted books of a memory-mapped library file.
+    
+    Only the offsets of the rows are kept in memory; fields are read from the
+    mapped file when a book is accessed.
+    """
+    
+    def __init__(self, mm, offsets, by_title=None):
+        self._mm = mm
+        self._offsets = offsets
+        self._by_title = by_title   # row numbers sorted by title, built on first lookup if not given
+    
+    @classmethod
+    def open(cls, library_file):
+        """Map a library file, return (MappedBooks, list of malformed rows).
+        
+        The row offsets are read from the index file written by Library.compact
+        when it matches the library file, otherwise the file is scanned. MappedBooks
+        is None if the file is not sorted by author.
+        """
+        with open(library_file, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else ""
+        
+        index = _read_index(library_file, stat)
+        if index is not None:
+            return cls(mm, *index), []
+        
+        offsets = array('L')
+        errors = []
+        is_sorted = True
+        previous_author = None
+        titles = set()
+        position = 0
+        line_number = 0
+        while position < size:
+            end = mm.find('\n', position)
+            if end == -1:
+                end = size
+            line_number += 1
+            row = mm[position:end]
+            if row.strip() != "":
+                try:
+                    title, author, isbn = parse_row(row)
+                except ValueError, err:
+                    errors.append((line_number, str(err)))
+                else:
+                    # duplicates are adjacent in a sorted file, only titles of the current author are tracked
+                    if author != previous_author:
+                        if previous_author is not None and author < previous_author:
+                            is_sorted = False
+                            break
+                        previous_author = author
+                        titles = set()
+                    if title not in titles:
+                        titles.add(title)
+                        offsets.append(position)
+            position = end + 1
+        
+        if not is_sorted:
+            if size > 0:
+                mm.close()
+            return None, errors
+        return cls(mm, offsets), errors
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def __getitem__(self, i):
+        return BookView(self._mm, self._offsets[i])
+    
+    def _field(self, i, field):
+        return _read_row(self._mm, self._offsets[i])[field]
+    
+    def _bisect_author(self, author, right=False):
+        """Return the row number where a book by author would be inserted."""
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = self._field(mid, 1)
+            if other < author or (right and other == author):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def contains(self, title, author):
+        """Check whether the book is in the mapped file."""
+        for i in xrange(self._bisect_author(author), len(self._offsets)):
+            other_title, other_author, isbn = _read_row(self._mm, self._offsets[i])
+            if other_author != author:
+                break
+            if other_title == title:
+                return True
+        return False
+    
+    def find_title(self, title):
+        """Find the first book in author order with the title, return None if not found."""
+        if self._by_title is None:
+            self._by_title = _title_order([self._field(i, 0) for i in xrange(len(self._offsets))])
+        lo, hi = 0, len(self._by_title)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._field(self._by_title[mid], 0) < title:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._by_title) and self._field(self._by_title[lo], 0) == title:
+            return self[self._by_title[lo]]
+        return None
+
+class MergedBooks(Sequence):
+    """Author-sorted view over a mapped library file and books added after it was mapped."""
+    
+    def __init__(self, mapped, books, authors):
+        self._mapped = mapped
+        self._books = books
+        # merged row numbers of the added books, they go after mapped books by the same author
+        self._positions = [mapped._bisect_author(author, right=True) + i for i, author in enumerate(authors)]
+    
+    def __len__(self):
+        return len(self._mapped) + len(self._books)
+    
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("book index out of range")
+        added = bisect.bisect_left(self._positions, i)
+        if added < len(self._positions) and self._positions[added] == i:
+            return self._books[added]
+        return self._mapped[i - added]
+
+INDEX_VERSION = 1
+
+def _title_order(titles):
+    """Return row numbers sorted by title, rows with the same title stay in author order."""
+    return array('L', sorted(xrange(len(titles)), key=titles.__getitem__))
+
+def _index_header(stat, count):
+    # the index is stale if the library file was replaced or modified after it was written
+    return "library index %i %i %i %i %r %i\n" % (INDEX_VERSION, array('L').itemsize, stat.st_ino,
+                                                   stat.st_size, stat.st_mtime, count)
+
+def _write_index(library_file, offsets, by_title):
+    """Write the row offsets and title order of a sorted library file next to it."""
+    header = _index_header(os.stat(library_file), len(offsets))
+    directory, filename = os.path.split(os.path.abspath(library_file))
+    fd, tmp_file = tempfile.mkstemp(prefix="." + filename, dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            offsets.tofile(f)
+            by_title.tofile(f)
+        os.rename(tmp_file, library_file + ".index")
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+def _read_index(library_file, stat):
+    """Return (offsets, title order) from the index of a library file, None if missing or stale."""
+    try:
+        with open(library_file + ".index", 'rb') as f:
+            header = f.readline()
+            count = int(header.split()[-1])
+            if header != _index_header(stat, count):
+                return None
+            offsets = array('L')
+            offsets.fromfile(f, count)
+            by_title = array('L')
+            by_title.fromfile(f, count)
+            return offsets, by_title
+    except (IOError, OSError, EOFError, ValueError, IndexError):
+        return None
+
+def _read_row(mm, offset):
+    """Read and parse the library file row at offset."""
+    end = mm.find('\n', offset)
+    return parse_row(mm[offset:] if end == -1 else mm[offset:end])
+
+def _table_header():
+    """Return the title and separator rows of a book table."""
+    title_row = ROW_FORMAT % ("Title", "Author", "ISBN")
+    return title_row + "-" * len(title_row) + '\n'
+
+def _format_row(book):
+    """Format a book as a library file row."""
+    return "%s\t%s\t%s\n" % (book['title'], book['author'], book['isbn'])
+
+class _JournalReader(object):
+    """Iterate over complete journal rows, counting them and their size in bytes.
+    
+    A last row without a newline is the result of an interrupted write and is
+    ignored.
+    """
+    
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+        self.size = 0
+    
+    def __iter__(self):
+        for row in self.rows:
+            if not row.endswith('\n'):
+                break
+            self.count += 1
+            self.size += len(row)
+            yield row
+
+def parse_row(row):
+    """Parse a library file row into (title, author, isbn), raise ValueError if malformed."""
+    fields = row.split('\t')
+    if len(fields) < 3:
+        raise ValueError("expected 3 tab separated fields, got %i" % len(fields))
+    title, author, isbn = [field.strip() for field in fields[:3]]
+    if title == "" or author == "":
+        raise ValueError("empty title or author")
+    return title, author, isbn
+
+def _write_chunk(rows):
+    """Sort rows and write them to a temporary chunk file."""
+    rows.sort()
+    chunk = tempfile.TemporaryFile()
+    for author, line_number, title, isbn in rows:
+        chunk.write("%s\t%s\t%s\t%i\n" % (title, author, isbn, line_number))
+    return chunk
+
+def _read_chunk(chunk_file):
+    """Yield (author, line number, title, isbn) tuples from a sorted chunk file."""
+    chunk_file.seek(0)
+    for row in chunk_file:
+        title, author, isbn, line_number = row.rstrip('\n').split('\t')
+        yield author, int(line_number), title, isbn
+
+def sort_library_file(input_file, output_file, chunk_size=SORT_CHUNK_SIZE):
+    """Sort and deduplicate a library file using an external merge sort.
+    
+    At most chunk_size rows are held in memory at a time. The sorted rows are
+    written to output_file, which may be a path or an open file. Returns list of
+    malformed rows as (line number, error) tuples.
+    """
+    errors = []
+    chunks = []
+    try:
+        with open(input_file, 'r') as f:
+            rows = []
+            for line_number, row in enumerate(f, 1):
+                if row.strip() == "":
+                    continue
+                try:
+                    title, author, isbn = parse_row(row)
+                except ValueError, err:
+                    errors.append((line_number, str(err)))
+                    continue
+                # line number keeps the order of books by the same author stable
+                rows.append((author, line_number, title, isbn))
+                if len(rows) >= chunk_size:
+                    chunks.append(_write_chunk(rows))
+                    rows = []
+            if rows:
+                chunks.append(_write_chunk(rows))
+        
+        out = open(output_file, 'w') if isinstance(output_file, basestring) else output_file
+        try:
+            # duplicates are adjacent once sorted, only titles of the current author are tracked
+            current_author = None
+            titles = set()
+            for author, line_number, title, isbn in heapq.merge(*[_read_chunk(chunk) for chunk in chunks]):
+                if author != current_author:
+                    current_author = author
+                    titles = set()
+                if title in titles:
+                    continue
+                titles.add(title)
+                out.write("%s\t%s\t%s\n" % (title, author, isbn))
+        finally:
+            if out is not output_file:
+                out.close()
+    finally:
+        for chunk in chunks:
+            chunk.close()
+    return errors
+
 def read_input(title):
     """Ask and read input from the user."""
     data = ""
@@ -77,12 +690,13 @@ def read_input(title):
 
 def main(library_file):
     library = Library(library_file)
-    library.read_library()
+    for line_number, err in library.read_library():
+        print "WARNING: Skipped malformed row %i in %s: %s" % (line_number, library_file, err)
     
     print "Welcome to Library Database!"
     cmd = ""
     while cmd != "Q":
-        print "\nOptions:\n1) Add new book to database\n2) List books in database\nQ) Exit\n"
+        print "\nOptions:\n1) Add new book to database\n2) List books in database\n3) Search books in database\nQ) Exit\n"
         
         cmd = raw_input("Command: ")
         
@@ -104,7 +718,24 @@ def main(library_file):
             
         elif cmd == "2":
             print "Listing database contents\n"
-            print library.list_books()
+            for row in library.render_books():
+                sys.stdout.write(row)
+        
+        elif cmd == "3":
+            query = read_input("Search (end with * for prefix search): ")
+            if query is None:
+                continue
+            if query.endswith("*"):
+                books = library.search_prefix(query[:-1])
+            else:
+                books = library.search(query)
+            
+            print "Found %i books\n" % len(books)
+            sys.stdout.write(_table_header())
+            for book in books:
+                sys.stdout.write(ROW_FORMAT % (book['title'], book['author'], book['isbn']))
+    
+    library.close()
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,116 @@
+"""Benchmark Library load, insert, lookup, render and save on synthetic catalogs.
+
+Each catalog size is measured in a separate process so that peak memory is
+reported per size. Results are written as JSON for comparing runs.
+
+Usage: python library_benchmark.py [--sizes 1000,10000,100000,1000000] [--mapped] [--output results.json]
+"""
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import resource
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import library
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+OPERATIONS = 1000
+
+def generate_library(library_file, rows, seed):
+    """Write a synthetic library file, return list of its titles."""
+    rng = random.Random(seed)
+    titles = []
+    with open(library_file, 'w') as f:
+        for i in xrange(rows):
+            title = "Title %i %08x" % (i, rng.getrandbits(32))
+            author = "Author %06i" % rng.randint(0, rows // 5)
+            f.write("%s\t%s\t%013i\n" % (title, author, rng.getrandbits(40)))
+            titles.append(title)
+    return titles
+
+def timed(function, *args, **kwargs):
+    """Call function, return (seconds, return value)."""
+    start = time.time()
+    ret = function(*args, **kwargs)
+    return time.time() - start, ret
+
+def run_size(rows, mapped, seed):
+    """Benchmark one catalog size, return dict of results."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        library_file = os.path.join(tmpdir, "library.txt")
+        titles = generate_library(library_file, rows, seed)
+        rng = random.Random(seed)
+        lookups = [rng.choice(titles) for i in xrange(OPERATIONS)]
+        del titles
+
+        result = {'rows': rows, 'mapped': mapped, 'operations': OPERATIONS}
+        lib = library.Library(library_file, compact_every=OPERATIONS + 1, mapped=mapped)
+        result['read_library_s'], errors = timed(lib.read_library)
+        assert not errors, errors
+
+        def add_books():
+            for i in xrange(OPERATIONS):
+                lib.add_book("Author %06i" % rng.randint(0, rows // 5), "New title %i" % i, "0")
+        result['add_book_s'], _ = timed(add_books)
+
+        def get_books():
+            for title in lookups:
+                assert lib.get_book(title) is not None
+        result['get_book_s'], _ = timed(get_books)
+
+        def render_books():
+            for row in lib.render_books():
+                pass
+        result['render_books_s'], _ = timed(render_books)
+        result['list_books_s'], _ = timed(lib.list_books)
+        result['save_s'], _ = timed(lib.save)
+        result['compact_s'], _ = timed(lib.compact)
+        # ru_maxrss is in kilobytes on Linux and bytes on OS X
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peak_rss_bytes'] = maxrss if sys.platform == "darwin" else maxrss * 1024
+        return result
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated catalog sizes")
+    parser.add_argument('--mapped', action='store_true', help="benchmark the memory-mapped mode")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write JSON results to a file instead of stdout")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print json.dumps(run_size(args.child, args.mapped, args.seed))
+        return
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        cmd = [sys.executable, os.path.abspath(__file__), '--child', str(size), '--seed', str(args.seed)]
+        if args.mapped:
+            cmd.append('--mapped')
+        result = json.loads(subprocess.check_output(cmd))
+        print >> sys.stderr, "%(rows)i rows: read %(read_library_s).3fs, list %(list_books_s).3fs" % result
+        results.append(result)
+
+    report = json.dumps({'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'seed': args.seed,
+                         'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
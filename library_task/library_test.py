@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import library
 
@@ -19,9 +22,179 @@ class TestLibrary(unittest.TestCase):
         self.library.add_book("Test author A","Test book 1","12345")
         self.assertEquals(self.library.get_books()[0]['author'], "Test author A")
         
+    def test_books_with_same_author_keep_insertion_order(self):
+        self.library.add_book("Test author B","Test book 3","12345")
+        self.library.add_book("Test author A","Test book 2","12345")
+        self.library.add_book("Test author A","Test book 1","12345")
+        self.assertEquals([book['title'] for book in self.library.get_books()],
+                          ["Test book 2", "Test book 1", "Test book 3"])
+
+    def test_get_book_returns_first_by_author(self):
+        self.library.add_book("Test author B","Test book","12345")
+        self.library.add_book("Test author A","Test book","67890")
+        self.assertEquals(self.library.get_book("Test book")['author'], "Test author A")
+        self.assertIsNone(self.library.get_book("Missing book"))
+
     def test_list_books(self):
         self.library.add_book("Test author","Test book","12345")
         self.assertIn("Test book", self.library.list_books())
 
+    def test_render_books(self):
+        for i in range(5):
+            self.library.add_book("Test author %i" % i, "Test book %i" % (4 - i), "12345")
+        rows = list(self.library.render_books(offset=1, limit=2, authors=("Test author 1", None), header=False))
+        self.assertEquals(len(rows), 2)
+        self.assertIn("Test author 2", rows[0])
+        self.assertIn("Test author 3", rows[1])
+        rows = list(self.library.render_books(titles=("Test book 1", "Test book 2"), header=False))
+        self.assertEquals(len(rows), 2)
+        self.assertIn("Test book 2", rows[0])
+
+    def test_render_pages(self):
+        for i in range(5):
+            self.library.add_book("Test author %i" % i, "Test book %i" % i, "12345")
+        pages = list(self.library.render_pages(page_size=2))
+        self.assertEquals(len(pages), 3)
+        self.assertTrue(all(page.startswith("Title") for page in pages))
+        self.assertIn("Test book 4", pages[2])
+
+    def test_search(self):
+        self.library.add_book("J.R.R. Tolkien", "The Hobbit", "1")
+        self.library.add_book("J.R.R. Tolkien", "The Two Towers", "2")
+        self.library.add_book("Terry Pratchett", "Small Gods", "3")
+        self.assertEquals([book['title'] for book in self.library.search("the TOLKIEN")],
+                          ["The Hobbit", "The Two Towers"])
+        self.assertEquals(self.library.search("hobbit pratchett"), [])
+        self.assertEquals([book['title'] for book in self.library.search_prefix("t")],
+                          ["The Hobbit", "The Two Towers", "Small Gods"])
+        self.assertEquals(len(self.library.search_prefix("the t", limit=1)), 1)
+
+class TestLibraryFile(unittest.TestCase):
+
+    ROWS = ["Book C\tAuthor B\t3\n",
+            "Book A\tAuthor A\t1\n",
+            "malformed row\n",
+            "Book B\tAuthor B\t2\n",
+            "Book A\tAuthor A\t1\n",
+            "\n",
+            "Book D\tAuthor A\t4\n"]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.library_file = os.path.join(self.tmpdir, "library.txt")
+        with open(self.library_file, 'w') as f:
+            f.writelines(self.ROWS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertLoaded(self, lib, errors):
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(errors[0][0], 3)
+        self.assertEquals([(book['author'], book['title']) for book in lib.get_books()],
+                          [("Author A", "Book A"), ("Author A", "Book D"),
+                           ("Author B", "Book C"), ("Author B", "Book B")])
+        self.assertEquals(lib.get_book("Book D")['isbn'], "4")
+
+    def test_read_library(self):
+        lib = library.Library(self.library_file)
+        self.assertLoaded(lib, lib.read_library())
+
+    def test_read_library_chunked(self):
+        lib = library.Library(self.library_file)
+        self.assertLoaded(lib, lib.read_library(chunk_size=2))
+
+    def test_save_appends_to_journal(self):
+        lib = library.Library(self.library_file)
+        lib.read_library()
+        lib.add_book("Author C", "Book E", "5")
+        lib.save()
+        with open(self.library_file) as f:
+            self.assertEquals(f.readlines(), self.ROWS)
+
+        reloaded = library.Library(self.library_file)
+        reloaded.read_library()
+        self.assertEquals(reloaded.get_book("Book E")['author'], "Author C")
+
+    def test_torn_journal_row_is_ignored(self):
+        with open(self.library_file + ".journal", 'w') as f:
+            f.write("Book E\tAuthor C\t5\nBook F\tAuthor C\t6")
+        lib = library.Library(self.library_file)
+        self.assertEquals(len(lib.read_library()), 1)
+        self.assertIsNotNone(lib.get_book("Book E"))
+        self.assertIsNone(lib.get_book("Book F"))
+
+    def test_save_after_torn_journal_row(self):
+        with open(self.library_file + ".journal", 'w') as f:
+            f.write("Book E\tAuthor C\t5\nBook F\tAuthor C\t6")
+        lib = library.Library(self.library_file)
+        lib.read_library()
+        lib.add_book("Author D", "Book G", "7")
+        lib.save()
+
+        reloaded = library.Library(self.library_file)
+        self.assertEquals(len(reloaded.read_library()), 1)
+        self.assertEquals(reloaded.get_book("Book E")['isbn'], "5")
+        self.assertIsNone(reloaded.get_book("Book F"))
+        self.assertEquals(reloaded.get_book("Book G")['isbn'], "7")
+
+    def test_compact(self):
+        lib = library.Library(self.library_file, compact_every=2)
+        lib.read_library()
+        lib.add_book("Author C", "Book E", "5")
+        lib.save()
+        self.assertTrue(os.path.exists(lib.journal_file))
+        lib.add_book("Author 0", "Book F", "6")
+        lib.save()
+        self.assertFalse(os.path.exists(lib.journal_file))
+        with open(self.library_file) as f:
+            self.assertEquals(f.readline(), "Book F\tAuthor 0\t6\n")
+            self.assertEquals(len(f.readlines()), 5)
+
+    def test_mapped_library_sorts_copy(self):
+        lib = library.Library(self.library_file, mapped=True)
+        self.assertLoaded(lib, lib.read_library(chunk_size=2))
+        with open(self.library_file) as f:
+            self.assertEquals(f.readlines(), self.ROWS)
+        with open(lib.sorted_file) as f:
+            self.assertEquals(f.readlines(), ["Book A\tAuthor A\t1\n", "Book D\tAuthor A\t4\n",
+                                              "Book C\tAuthor B\t3\n", "Book B\tAuthor B\t2\n"])
+        self.assertLoaded(lib, lib.read_library())
+
+    def test_mapped_library(self):
+        lib = library.Library(self.library_file, compact_every=2, mapped=True)
+        self.assertLoaded(lib, lib.read_library())
+        self.assertEquals(dict(lib.get_book("Book C")), {'title': "Book C", 'author': "Author B", 'isbn': "3"})
+        self.assertFalse(lib.add_book("Author A", "Book A", "1"))
+        self.assertTrue(lib.add_book("Author A", "Book E", "5"))
+        self.assertEquals([book['title'] for book in lib.get_books()], ["Book A", "Book D", "Book E", "Book C", "Book B"])
+        self.assertIn("Book E", lib.list_books())
+        self.assertEquals([book['title'] for book in lib.search("book author a")], ["Book A", "Book D", "Book E"])
+
+        lib.add_book("Author 0", "Book A", "6")
+        self.assertEquals(lib.get_book("Book A")['author'], "Author 0")
+        lib.save()
+        self.assertEquals(len(lib.books), 0)
+        self.assertEquals(len(lib.get_books()), 6)
+        self.assertEquals(lib.get_book("Book A")['author'], "Author 0")
+
+    def test_mapped_library_index(self):
+        lib = library.Library(self.library_file)
+        lib.read_library()
+        lib.compact()
+        self.assertTrue(os.path.exists(self.library_file + ".index"))
+        mapped, errors = library.MappedBooks.open(self.library_file)
+        self.assertIsNotNone(mapped._by_title)
+        self.assertEquals([book['title'] for book in mapped], ["Book A", "Book D", "Book C", "Book B"])
+        self.assertEquals(mapped.find_title("Book C")['isbn'], "3")
+
+        # a changed library file is scanned again instead of using the stale index
+        with open(self.library_file, 'a') as f:
+            f.write("Book E\tAuthor C\t5\n")
+        mapped, errors = library.MappedBooks.open(self.library_file)
+        self.assertIsNone(mapped._by_title)
+        self.assertEquals(len(mapped), 5)
+        self.assertEquals(mapped.find_title("Book E")['author'], "Author C")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
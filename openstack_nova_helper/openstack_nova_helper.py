@@ -1,10 +1,428 @@
 import sys
 import os
 import time
+import random
+import bisect
+import functools
+import threading
+import contextlib
+from multiprocessing.pool import ThreadPool
 
 from novaclient import client as nova_client
 from novaclient import exceptions as nova_exception
 
+# seconds to cache resource listings, 0 disables caching of a resource
+CACHE_TTLS = {'images': 300,
+              'flavors': 3600,
+              'networks': 600,
+              'security_groups': 60}
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _Operation(object):
+    """Helper method call in progress, shared with the threads it starts."""
+    
+    def __init__(self, name):
+        self.name = name
+        self.api_calls = 0
+        self.logged_errors = 0
+
+class ApiMetrics(object):
+    """Thread-safe counts, error counts and latency histograms of Nova API calls and helper operations.
+    
+    API calls are recorded per client method, e.g. 'servers.list', and attributed to the
+    outermost helper method, e.g. 'create_instance', running in the calling thread.
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self._api = {}
+            self._operations = {}
+    
+    def _record(self, table, name, seconds, error=None):
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = {'calls': 0, 'seconds': 0.0, 'errors': {}, 'buckets': [0] * (len(self.buckets) + 1)}
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+        if error is not None:
+            entry['errors'][error] = entry['errors'].get(error, 0) + 1
+        return entry
+    
+    def current(self):
+        return getattr(self._local, 'operation', None)
+    
+    @contextlib.contextmanager
+    def attach(self, operation):
+        """Attribute API calls in this thread to an operation started in another thread."""
+        previous = self.current()
+        self._local.operation = operation
+        try:
+            yield
+        finally:
+            self._local.operation = previous
+    
+    @contextlib.contextmanager
+    def operation(self, name):
+        """Record a helper method call and the API calls it makes, unless already inside one."""
+        if self.current() is not None:
+            yield
+            return
+        operation = self._local.operation = _Operation(name)
+        start_time = time.time()
+        error = None
+        try:
+            yield
+        except Exception, ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            self._local.operation = None
+            with self._lock:
+                entry = self._record(self._operations, name, time.time() - start_time, error)
+                entry['api_calls'] = entry.get('api_calls', 0) + operation.api_calls
+                if operation.logged_errors:
+                    entry['errors']['logged'] = entry['errors'].get('logged', 0) + 1
+    
+    def call(self, name, function, args=(), kwargs={}):
+        """Return function(*args, **kwargs) of the Nova API, recording the call under name."""
+        start_time = time.time()
+        error = None
+        try:
+            return function(*args, **kwargs)
+        except Exception, ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            seconds = time.time() - start_time
+            operation = self.current()
+            with self._lock:
+                self._record(self._api, name, seconds, error)
+                if operation is not None:
+                    operation.api_calls += 1
+    
+    def log_error(self):
+        """Count an error logged by the helper for the current operation."""
+        operation = self.current()
+        if operation is not None:
+            with self._lock:
+                operation.logged_errors += 1
+    
+    def stats(self):
+        """Return {'api': {method: stats}, 'operations': {method: stats}} with mean latency and histogram."""
+        def summary(entry):
+            summary = dict((key, value) for key, value in entry.items() if key != 'buckets')
+            summary['errors'] = dict(entry['errors'])
+            summary['mean_seconds'] = entry['seconds'] / entry['calls']
+            summary['histogram'] = zip([str(bound) for bound in self.buckets] + ['+Inf'], entry['buckets'])
+            return summary
+        with self._lock:
+            return {'api': dict((name, summary(entry)) for name, entry in self._api.items()),
+                    'operations': dict((name, summary(entry)) for name, entry in self._operations.items())}
+
+class InstrumentedClient(object):
+    """Proxy of a novaclient client, manager or resource recording method calls in ApiMetrics.
+    
+    Calls are named after the manager, e.g. 'servers.list' and, for a server it returned, 'servers.delete'.
+    """
+    
+    def __init__(self, target, metrics, name=None):
+        self._target = target
+        self._metrics = metrics
+        self._name = name
+    
+    def _wrap(self, value, name):
+        if isinstance(value, list):
+            return [self._wrap(item, name) for item in value]
+        if hasattr(value, '__dict__') and not isinstance(value, type):
+            return InstrumentedClient(value, self._metrics, name)
+        return value
+    
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if self._name is None:
+            # managers of the client, e.g. client.servers
+            return self._wrap(value, attr) if not callable(value) else value
+        if not callable(value):
+            return value
+        name = "%s.%s" % (self._name, attr)
+        
+        def call(*args, **kwargs):
+            return self._wrap(self._metrics.call(name, value, args, kwargs), self._name)
+        return call
+    
+    def __repr__(self):
+        return repr(self._target)
+
+def _operation(method):
+    """Record calls of a helper method in self.metrics."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class ResourceCache(object):
+    """Thread-safe cache of Nova resource listings with a TTL per resource type and hit and miss counters."""
+    
+    def __init__(self, ttls=None):
+        self.ttls = dict(CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        self._entries = {}   # resource -> (expires, loaded, value)
+        self._counters = {}
+        self._lock = threading.Lock()
+    
+    def enabled(self, resource):
+        return self.ttls.get(resource, 0) > 0
+    
+    def _count(self, resource, counter):
+        counters = self._counters.setdefault(resource, {'hits': 0, 'misses': 0, 'invalidations': 0})
+        counters[counter] += 1
+    
+    def get(self, resource, load):
+        """Return cached value of resource, calling load() when it is missing or expired."""
+        with self._lock:
+            item = self._entries.get(resource)
+            if item is not None and item[0] > time.time():
+                self._count(resource, 'hits')
+                return item[2]
+            self._count(resource, 'misses')
+        # loaded without holding the lock, concurrent misses may both load
+        value = load()
+        self.put(resource, value)
+        return value
+    
+    def put(self, resource, value):
+        if not self.enabled(resource):
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[resource] = (now + self.ttls[resource], now, value)
+    
+    def invalidate(self, resource=None):
+        """Drop one cached resource listing, or all of them."""
+        with self._lock:
+            for cached in ([resource] if resource is not None else self._entries.keys()):
+                if self._entries.pop(cached, None) is not None:
+                    self._count(cached, 'invalidations')
+    
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            stats = {}
+            for resource in set(self.ttls) | set(self._counters):
+                item = self._entries.get(resource)
+                stats[resource] = dict(self._counters.get(resource, {'hits': 0, 'misses': 0, 'invalidations': 0}),
+                                       ttl=self.ttls.get(resource, 0),
+                                       size=len(item[2]) if item is not None else 0,
+                                       age=now - item[1] if item is not None else None)
+            return stats
+
+class InstanceFuture(object):
+    """Pending wait for an instance to get a status, resolved by InstanceWaiter.
+    
+    Once done, instance is the instance dict, or None and error tells why waiting failed.
+    """
+    
+    def __init__(self, name, status, timeout_seconds):
+        self.name = name
+        self.status = status
+        self.timeout_seconds = timeout_seconds
+        self.deadline = time.time() + timeout_seconds
+        self.status_time = None   # when status was first seen, networks are assigned after that
+        self.instance = None
+        self.error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    def done(self):
+        return self._done.is_set()
+    
+    def result(self, timeout=None):
+        """Wait until done, return the instance dict or None."""
+        self._done.wait(timeout)
+        return self.instance
+    
+    def add_done_callback(self, callback):
+        """Call callback(future) when done, immediately if already done."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+    
+    def _resolve(self, instance=None, error=None):
+        """Set the outcome unless already done, return the callbacks to call."""
+        with self._lock:
+            if self._done.is_set():
+                return []
+            self.instance = instance
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        return callbacks
+
+class InstanceWaiter(object):
+    """Waits for any number of instances to get a status with one detailed server listing per poll.
+    
+    The poll interval starts at min_interval and grows by backoff up to max_interval
+    while none of the instances change status. Polling runs in a daemon thread
+    that exits when nothing is waited for.
+    """
+    
+    # seconds to wait for networks to be assigned once an instance has the status
+    NETWORK_TIMEOUT = 20
+    
+    def __init__(self, helper, min_interval=1.0, max_interval=10.0, backoff=1.5):
+        self.helper = helper
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.polls = 0
+        self._interval = min_interval
+        self._pending = []
+        self._statuses = {}   # name -> status seen in the last poll
+        self._condition = threading.Condition()
+        self._thread = None
+    
+    def wait(self, name, status="ACTIVE", timeout_seconds=300, callback=None):
+        """Start waiting for an instance, return an InstanceFuture.
+        
+        The future is done when the instance has the status and networks, goes to ERROR,
+        is not found, or the timeout passes. callback(future) is called when it is done.
+        """
+        future = InstanceFuture(name, status, timeout_seconds)
+        if callback is not None:
+            future.add_done_callback(callback)
+        with self._condition:
+            self._pending.append(future)
+            self._interval = self.min_interval
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="InstanceWaiter")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return future
+    
+    def result(self, future):
+        """Return future.result(), waiting at most until a poll should have failed it.
+        
+        A future still pending then fails, so a stuck poll cannot block the caller forever.
+        """
+        timeout = future.deadline + self.NETWORK_TIMEOUT + self.max_interval - time.time()
+        future.result(max(timeout, 0))
+        if not future.done():
+            self._finish(future, None, "Timed out waiting for instance '%s' to get status '%s'" % (future.name, future.status))
+        return future.instance
+    
+    def _run(self):
+        last_poll = 0
+        try:
+            while True:
+                with self._condition:
+                    while True:
+                        if not self._pending:
+                            self._thread = None
+                            return
+                        # new waits shorten the interval but still poll at most once per min_interval
+                        delay = last_poll + self._interval - time.time()
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    pending = list(self._pending)
+                    interval = self._interval
+                last_poll = time.time()
+                with self.helper.metrics.operation("InstanceWaiter.poll"):
+                    changed = self._poll(pending)
+                with self._condition:
+                    self._pending = [future for future in self._pending if not future.done()]
+                    # also forgets futures that timed out in InstanceWaiter.result
+                    names = set(future.name for future in self._pending)
+                    for name in self._statuses.keys():
+                        if name not in names:
+                            del self._statuses[name]
+                    if self._interval == interval:
+                        self._interval = self.min_interval if changed else min(interval * self.backoff, self.max_interval)
+        except Exception, ex:
+            # fail everything waited for, the next wait starts a new thread
+            self.helper._log_error("ERROR: Waiting for instances failed: %s" % str(ex))
+            with self._condition:
+                pending, self._pending = self._pending, []
+                self._statuses = {}
+                self._thread = None
+            for future in pending:
+                self._finish(future, None, "Waiting for instance '%s' failed: %s" % (future.name, str(ex)))
+    
+    def _poll(self, pending):
+        """List servers once and resolve the pending futures it decides, return True if any status changed."""
+        try:
+            servers = self.helper._call_with_backoff(self.helper.client.servers.list, detailed=True)
+        except Exception, ex:
+            self.helper._log_error("ERROR: Failed to list instances: %s" % str(ex))
+            servers = None
+        self.polls += 1
+        now = time.time()
+        
+        by_name = {}
+        for server in servers or []:
+            by_name.setdefault(server.name, []).append(server)
+        changed = False
+        ready = []
+        resolved = []
+        for future in pending:
+            error = None
+            if servers is not None:
+                matches = by_name.get(future.name, [])
+                if len(matches) != 1:
+                    error = ("Instance '%s' not found" if not matches else "More than one instance named '%s'") % future.name
+                else:
+                    server = matches[0]
+                    if self._statuses.get(future.name) != server.status:
+                        self._statuses[future.name] = server.status
+                        changed = True
+                    if server.status == future.status:
+                        # networks get NETWORK_TIMEOUT seconds from when the status was seen, even past the deadline
+                        future.status_time = future.status_time or now
+                        if len(server.networks) > 0:
+                            ready.append((future, server))
+                        elif now - future.status_time > self.NETWORK_TIMEOUT:
+                            resolved.append((future, None, "No networks found for instance '%s'" % future.name))
+                        continue
+                    elif server.status == "ERROR":
+                        error = "Instance '%s' got status 'ERROR' while waiting for '%s'" % (future.name, future.status)
+            if error is None and now > future.deadline:
+                error = "Instance '%s' did not get status '%s' within %i seconds" % (future.name, future.status, future.timeout_seconds)
+            if error is not None:
+                resolved.append((future, None, error))
+        
+        if ready:
+            try:
+                instances = self.helper._join_instances([server for future, server in ready])
+                resolved.extend((future, instance, None) for (future, server), instance in zip(ready, instances))
+            except Exception, ex:
+                # left pending, the next poll tries again
+                self.helper._log_error("ERROR: Failed to get instance details: %s" % str(ex))
+        for future, instance, error in resolved:
+            self._finish(future, instance, error)
+        return changed or bool(resolved)
+    
+    def _finish(self, future, instance, error):
+        """Resolve future and call its callbacks."""
+        for callback in future._resolve(instance, error):
+            try:
+                callback(future)
+            except Exception, ex:
+                self.helper._log_error("ERROR: Callback for instance '%s' failed: %s" % (future.name, str(ex)))
+
 class OpenStackNovaHelper(object):
     
     FLAVORS = {'1cpu1024m': 'm2.tiny',
@@ -12,20 +430,43 @@ class OpenStackNovaHelper(object):
                '2cpu2048m': 'm2.medium',
                '2cpu4096m': 'm3.medium'}
     
-    def __init__(self, api_version="2", log=None, username=None, password=None, tenant_name=None, auth_url=None):
+    # retries and first delay in seconds, doubled per retry, when Nova answers with a rate limit
+    RATE_LIMIT_RETRIES = 6
+    RATE_LIMIT_BACKOFF = 1.0
+    RATE_LIMIT_BACKOFF_MAX = 60.0
+    
+    def __init__(self, api_version="2", log=None, username=None, password=None, tenant_name=None, auth_url=None, client=None, cache_ttls=None):
+        # an already created client, e.g. a fake novaclient for testing, can be given instead of credentials
         try:
-            self.client = nova_client.Client(api_version, os.environ['OS_USERNAME'] if username is None else username,
-                                                          os.environ['OS_PASSWORD'] if password is None else password,
-                                                          os.environ['OS_TENANT_NAME'] if tenant_name is None else tenant_name,
-                                                          os.environ['OS_AUTH_URL'] if auth_url is None else auth_url)
+            if client is None:
+                client = nova_client.Client(api_version, os.environ['OS_USERNAME'] if username is None else username,
+                                                         os.environ['OS_PASSWORD'] if password is None else password,
+                                                         os.environ['OS_TENANT_NAME'] if tenant_name is None else tenant_name,
+                                                         os.environ['OS_AUTH_URL'] if auth_url is None else auth_url)
         except Exception, ex:
             print "Failed to create Nova client: %s" % str(ex)
             raise ex
-        
+
+        # calls through self.client are counted and timed in self.metrics
+        self.metrics = ApiMetrics()
+        self.client = InstrumentedClient(client, self.metrics)
         self.log = log
+        # the last error is kept per thread so that batch operations report their own errors
+        self._local = threading.local()
+        self.cache = ResourceCache(cache_ttls)
+        self.waiter = InstanceWaiter(self)
+    
+    @property
+    def error(self):
+        return getattr(self._local, 'error', None)
+    
+    @error.setter
+    def error(self, err):
+        self._local.error = err
     
     def _log_error(self, err):
         self.error = err
+        self.metrics.log_error()
         if self.log is not None:
             self.log.error(err)
         else:
@@ -34,27 +475,60 @@ class OpenStackNovaHelper(object):
     def get_error(self):
         return self.error
     
+    def _call_with_backoff(self, function, *args, **kwargs):
+        """Call function, retrying with exponential backoff while Nova answers with a rate limit."""
+        delay = self.RATE_LIMIT_BACKOFF
+        for retry in range(self.RATE_LIMIT_RETRIES + 1):
+            try:
+                return function(*args, **kwargs)
+            except nova_exception.OverLimit, ex:
+                # OverLimit (413) is also the base class of RateLimit (429)
+                if retry == self.RATE_LIMIT_RETRIES:
+                    raise
+                retry_after = getattr(ex, 'retry_after', 0) or 0
+                # jitter keeps the threads of a batch from retrying all at once
+                time.sleep(max(float(retry_after), delay * random.uniform(0.5, 1.5)))
+                delay = min(delay * 2, self.RATE_LIMIT_BACKOFF_MAX)
+    
+    def invalidate_cache(self, resource=None):
+        """Forget cached 'images', 'flavors', 'networks' or 'security_groups', or all of them."""
+        self.cache.invalidate(resource)
+    
+    def cache_stats(self):
+        return self.cache.stats()
+    
+    def api_stats(self):
+        """Return Nova API call counts, errors and latencies per client method and per helper method."""
+        return self.metrics.stats()
+    
+    def _load_resource(self, resource):
+        if resource == 'images':
+            return [self.get_image(image_obj=image) for image in self.client.images.list()]
+        if resource == 'flavors':
+            return [self.get_flavor(flavor_obj=flavor) for flavor in self.client.flavors.list()]
+        if resource == 'networks':
+            return [{'label': network.label, 'id': network.id} for network in self.client.networks.list()]
+        if resource == 'security_groups':
+            return [security_group.name for security_group in self.client.security_groups.list()]
+        raise ValueError("Unknown resource '%s'" % resource)
+    
+    def _cached_list(self, resource):
+        """Return the listing of a resource, from the cache while it has not expired."""
+        return self.cache.get(resource, lambda: self._load_resource(resource))
+    
+    def _find_cached(self, resource, key, value):
+        """Return a copy of the only cached resource whose key matches value, or None to look it up from Nova."""
+        if value is None or not self.cache.enabled(resource):
+            return None
+        matches = [item for item in self._cached_list(resource) if item[key] == value]
+        # new and non-unique names are left for Nova to resolve or report
+        return dict(matches[0]) if len(matches) == 1 else None
+    
+    @_operation
     def create_instance(self, name, image, flavor="m2.small", security_groups=['default'], networks=['defaultnetwork'], wait_status=None):
         try:
-            assert self.get_instance(name=name) is None, "Instance '%s' already exists" % name
-            assert self.get_image(name=image) is not None, self.get_error()
-            assert self.get_flavor(name=flavor) is not None, self.get_error()
-            for sec_group in security_groups:
-                assert sec_group in self.list_security_groups(), "Security group '%s' not found" % sec_group
-            for nw in networks:
-                assert self.get_network(nw) is not None, self.get_error()
-            
-            nics = []
-            for net in networks:
-                network = self.get_network(net)
-                if network is not None: 
-                    nics.append({'net-id': network['id']})
-            
-            instance = self.client.servers.create(name=name,
-                                                  image=self.get_image(image)['id'],
-                                                  flavor=self.get_flavor(name=flavor)['id'],
-                                                  security_groups=security_groups,
-                                                  nics=nics)
+            assert self._find_server(name) is None, "Instance '%s' already exists" % name
+            instance = self._create_server(name, image, flavor, security_groups, networks)
             
             if wait_status:
                 assert self.wait_instance_status(name, status=wait_status), self.get_error()
@@ -64,33 +538,129 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to create instance '%s': %s" % (name, str(ex)))
             return None
     
+    def _find_server(self, name):
+        """Return the server named name, or None without logging an error if there is none."""
+        try:
+            return self.client.servers.find(name=name)
+        except nova_exception.NotFound:
+            return None
+    
+    def _create_server(self, name, image, flavor="m2.small", security_groups=['default'], networks=['defaultnetwork']):
+        """Resolve image, flavor, security groups and networks and create the server, raise on errors."""
+        image_info = self.get_image(name=image)
+        assert image_info is not None, self.get_error()
+        flavor_info = self.get_flavor(name=flavor)
+        assert flavor_info is not None, self.get_error()
+        missing_groups = set(security_groups) - set(self._cached_list('security_groups'))
+        if missing_groups:
+            # the group may have been created after the listing was cached
+            self.invalidate_cache('security_groups')
+            missing_groups -= set(self._cached_list('security_groups'))
+        assert not missing_groups, "Security group '%s' not found" % sorted(missing_groups)[0]
+        
+        nics = []
+        for nw in networks:
+            network = self.get_network(nw)
+            assert network is not None, self.get_error()
+            nics.append({'net-id': network['id']})
+        
+        return self._call_with_backoff(self.client.servers.create,
+                                       name=name,
+                                       image=image_info['id'],
+                                       flavor=flavor_info['id'],
+                                       security_groups=security_groups,
+                                       nics=nics)
+    
+    @_operation
+    def create_instances(self, instances, max_workers=10, wait_status=None, timeout_seconds=300):
+        """Create instances concurrently on at most max_workers threads.
+        
+        instances is a list of dicts of create_instance arguments, e.g. {'name': 'vm1', 'image': 'ubuntu'}.
+        Returns a list of {'name', 'instance', 'error'} dicts in the same order, where instance is
+        the created instance or None and error is the reason it failed.
+        """
+        names = [spec['name'] for spec in instances]
+        try:
+            existing = set(server.name for server in self._call_with_backoff(self.client.servers.list))
+        except Exception, ex:
+            self._log_error("ERROR: Failed to list instances: %s" % str(ex))
+            return [{'name': name, 'instance': None, 'error': self.get_error()} for name in names]
+        # list the cached resources once here instead of in every thread
+        for resource in self.cache.ttls:
+            if self.cache.enabled(resource):
+                try:
+                    self._cached_list(resource)
+                except Exception:
+                    pass
+        
+        def create(spec):
+            spec = dict(spec)
+            name = spec.pop('name')
+            wait = spec.pop('wait_status', wait_status)
+            try:
+                assert name not in existing, "Instance '%s' already exists" % name
+                assert names.count(name) == 1, "Instance '%s' requested more than once" % name
+                instance = self._create_server(name, **spec)
+                if wait:
+                    # waited for together once all creates are done
+                    return {'name': name, 'instance': None, 'error': None}, wait
+                return {'name': name, 'instance': self.get_instance(instance_obj=instance), 'error': None}, None
+            except Exception, ex:
+                self._log_error("ERROR: Failed to create instance '%s': %s" % (name, str(ex)))
+                return {'name': name, 'instance': None, 'error': self.get_error()}, None
+        
+        results = self._run_batch(create, instances, max_workers)
+        futures = [self.waiter.wait(result['name'], wait, timeout_seconds) if wait else None for result, wait in results]
+        for (result, wait), future in zip(results, futures):
+            if future is not None:
+                result['instance'] = self.waiter.result(future)
+                if result['instance'] is None:
+                    self._log_error("ERROR: Failed to create instance '%s': %s" % (result['name'], future.error))
+                    result['error'] = self.get_error()
+        return [result for result, wait in results]
+    
+    def _run_batch(self, function, items, max_workers):
+        """Return [function(item) for item in items], computed on a pool of at most max_workers threads."""
+        if not items:
+            return []
+        operation = self.metrics.current()
+        
+        def run(item):
+            with self.metrics.attach(operation):
+                return function(item)
+        
+        pool = ThreadPool(min(max_workers, len(items)))
+        try:
+            return pool.map(run, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    
+    @_operation
     def wait_instance_status(self, instance_name, status="ACTIVE", timeout_seconds=300):
-        instance = self.get_instance(instance_name, get_console=False)
-        if instance is None:
+        """Wait until the instance has the status and networks assigned, return True on success."""
+        future = self.waiter.wait(instance_name, status, timeout_seconds)
+        if self.waiter.result(future) is None:
+            self._log_error(future.error)
             return False
+        return True
+    
+    @_operation
+    def wait_instances(self, instance_names, status="ACTIVE", timeout_seconds=300, callback=None):
+        """Start waiting for instances to get the status and networks, return an InstanceFuture per name.
         
-		start_time = time.time()
-        while True:
-            if instance is not None and 'status' in instance and instance['status'] == status:
-                break
-            if (time.time() - start_time) > timeout_seconds:
-                self._log_error("Instance '%s' did not get status '%s' within %i seconds" % (instance_name, status, timeout_seconds))
-                return False
-            time.sleep(5)
-            instance = self.get_instance(instance_name, get_console=False)
-        
-		# assigning networks to instance is delayed
-        for i in range(20):
-            if len(instance['networks']) > 0:
-                return True
-            time.sleep(1)
-            instance = self.get_instance(instance_name, get_console=False)
-        self._log_error("No networks found for instance '%s'" % instance_name)
-        return False
+        All waits share one server listing per poll. callback(future) is called as each one is done,
+        from the polling thread.
+        """
+        return [self.waiter.wait(name, status, timeout_seconds, callback) for name in instance_names]
     
+    @_operation
     def get_image(self, name=None, id=None, image_obj=None):
         try:
             if image_obj is None:
+                image = self._find_cached('images', 'name', name) if name is not None else self._find_cached('images', 'id', id)
+                if image is not None:
+                    return image
                 image_obj = self.client.images.find(name=name) if name is not None else self.client.images.find(id=id)
             return {'name': image_obj.name,
                     'id': image_obj.id,
@@ -104,9 +674,13 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Nova client exception: %s" % str(ex))
             return None
         
+    @_operation
     def get_flavor(self, name=None, id=None, flavor_obj=None):
         try:
             if flavor_obj is None:
+                flavor = self._find_cached('flavors', 'name', name) if name is not None else self._find_cached('flavors', 'id', id)
+                if flavor is not None:
+                    return flavor
                 flavor_obj = self.client.flavors.find(name=name) if name is not None else self.client.flavors.find(id=id)
             return {'name': flavor_obj.name,
                     'id': flavor_obj.id,
@@ -120,29 +694,41 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Nova client exception: %s" % str(ex))
             return None
 
+    @_operation
     def get_instance(self, name=None, instance_obj=None, get_console=False):
         try:
             if instance_obj is None:
                 instance_obj = self.client.servers.find(name=name)
-            return {'name': instance_obj.name,
-                    'id': instance_obj.id,
-                    'status': instance_obj.status,
-                    'created': instance_obj.created,
-                    'updated': instance_obj.updated,
-                    'image': self.get_image(id=instance_obj.image['id']),
-                    'flavor': self.get_flavor(id=instance_obj.flavor['id']),
-                    'networks': instance_obj.networks,
-                    'security_groups': [sg.name for sg in instance_obj.list_security_group()],
-                    'console': instance_obj.get_spice_console("spice-html5") if get_console else None}
+            return self._instance_dict(instance_obj,
+                                       self.get_image(id=instance_obj.image['id']),
+                                       self.get_flavor(id=instance_obj.flavor['id']),
+                                       [sg.name for sg in instance_obj.list_security_group()],
+                                       get_console)
         except nova_exception.NotFound:
             self._log_error("ERROR: Instance '%s' not found" % name)
             return None
         except nova_exception.ClientException, ex:
             self._log_error("ERROR: Nova client exception: %s" % str(ex))
             return None
+    
+    def _instance_dict(self, instance_obj, image, flavor, security_groups, get_console=False):
+        return {'name': instance_obj.name,
+                'id': instance_obj.id,
+                'status': instance_obj.status,
+                'created': instance_obj.created,
+                'updated': instance_obj.updated,
+                'image': image,
+                'flavor': flavor,
+                'networks': instance_obj.networks,
+                'security_groups': security_groups,
+                'console': instance_obj.get_spice_console("spice-html5") if get_console else None}
         
+    @_operation
     def get_network(self, label):
         try:
+            network = self._find_cached('networks', 'label', label)
+            if network is not None:
+                return network
             network = self.client.networks.find(label=label)
             return {'label': network.label,
                     'id': network.id}
@@ -153,6 +739,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Nova client exception: %s" % str(ex))
             return None
 
+    @_operation
     def get_floating_ip(self, ip=None, floating_ip_obj=None):
         try:
             if floating_ip_obj is None:
@@ -167,6 +754,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Nova client exception: %s" % str(ex))
             return None
 
+    @_operation
     def create_floating_ip(self, pool="Ext-Access"):
         try:
             floating_ip = self.client.floating_ips.create(pool)
@@ -177,6 +765,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to create floating IP in pool '%s': %s" % (pool, str(ex)))
             return None
         
+    @_operation
     def delete_floating_ip(self, floating_ip):
         try:
             floating_ip = self.client.floating_ips.find(ip=floating_ip)
@@ -186,36 +775,70 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to delete floating IP '%s': %s" % (floating_ip, str(ex)))
             return False
     
+    @_operation
     def list_images(self):
-        images = []
-        for image in self.client.images.list():
-            images.append(self.get_image(image_obj=image))
-        return images
+        # explicit listings are always fetched and refresh the cache
+        images = self._load_resource('images')
+        self.cache.put('images', images)
+        return [dict(image) for image in images]
         
+    @_operation
     def list_flavors(self):
-        flavors = []
-        for flavor in self.client.flavors.list():
-            flavors.append(self.get_flavor(flavor_obj=flavor))
-        return flavors
+        flavors = self._load_resource('flavors')
+        self.cache.put('flavors', flavors)
+        return [dict(flavor) for flavor in flavors]
 
+    @_operation
     def list_security_groups(self):
-        security_groups = []
-        for security_group in self.client.security_groups.list():
-            security_groups.append(security_group.name)
-        return security_groups
+        security_groups = self._load_resource('security_groups')
+        self.cache.put('security_groups', security_groups)
+        return list(security_groups)
     
-    def list_instances(self):
+    @_operation
+    def list_instances(self, security_groups=True):
+        """Return all instances, joined client-side with images and flavors listed once.
+        
+        Security groups are taken from the detailed server listing, or left as None
+        with security_groups=False.
+        """
+        return self._join_instances(self.client.servers.list(detailed=True), security_groups)
+    
+    def _join_instances(self, instance_objs, security_groups=True):
+        """Return instance dicts of detailed server objects, with images and flavors from the cached listings."""
+        images = dict((image['id'], dict(image)) for image in self._cached_list('images'))
+        flavors = dict((flavor['id'], dict(flavor)) for flavor in self._cached_list('flavors'))
         instances = []
-        for instance in self.client.servers.list():
-            instances.append(self.get_instance(instance_obj=instance, get_console=False))
+        for instance in instance_objs:
+            image_id = instance.image['id']
+            if image_id not in images:
+                # e.g. private or deleted images are not in the listing
+                images[image_id] = self.get_image(id=image_id)
+            flavor_id = instance.flavor['id']
+            if flavor_id not in flavors:
+                flavors[flavor_id] = self.get_flavor(id=flavor_id)
+            instances.append(self._instance_dict(instance, images[image_id], flavors[flavor_id],
+                                                 self._instance_security_groups(instance) if security_groups else None))
         return instances
     
+    def _instance_security_groups(self, instance_obj):
+        """Return security group names of an instance, without an API call when the server listing has them."""
+        if not hasattr(instance_obj, 'security_groups'):
+            return [sg.name for sg in instance_obj.list_security_group()]
+        # groups are listed once per port
+        names = []
+        for sg in instance_obj.security_groups:
+            if sg['name'] not in names:
+                names.append(sg['name'])
+        return names
+    
+    @_operation
     def list_floating_ips(self):
         floating_ips = []
         for floating_ip in self.client.floating_ips.list():
             floating_ips.append(self.get_floating_ip(floating_ip_obj=floating_ip))
         return floating_ips
     
+    @_operation
     def add_security_group_to_instance(self, instance_name, security_group):
         try:
             instance = self.client.servers.find(name=instance_name)
@@ -225,6 +848,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to add security group '%s' to instance %s: %s" % (security_group, instance_name, str(ex)))
             return False
     
+    @_operation
     def add_floating_ip_to_instance(self, instance_name, floating_ip):
         try:
             instance = self.client.servers.find(name=instance_name)
@@ -234,6 +858,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to add floating IP address '%s' to instance '%s': %s" % (floating_ip, instance_name, str(ex)))
             return False
     
+    @_operation
     def reboot_instance(self, instance_name, reboot_type="SOFT"):
         try:
             instance = self.client.servers.find(name=instance_name)
@@ -243,6 +868,7 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to %s-reboot instance '%s': %s" % (reboot_type, instance_name, str(ex)))
             return False
     
+    @_operation
     def suspend_instance(self, instance_name):
         try:
             instance = self.client.servers.find(name=instance_name)
@@ -252,11 +878,38 @@ class OpenStackNovaHelper(object):
             self._log_error("ERROR: Failed to suspend instance '%s': %s" % (instance_name, str(ex)))
             return False
     
+    @_operation
     def delete_instance(self, instance_name):
         try:
             instance = self.client.servers.find(name=instance_name)
-            instance.delete()
+            self._call_with_backoff(instance.delete)
             return True
         except Exception, ex:
             self._log_error("ERROR: Failed to delete instance '%s': %s" % (instance_name, str(ex)))
             return False
+    
+    @_operation
+    def delete_instances(self, instance_names, max_workers=10):
+        """Delete instances concurrently on at most max_workers threads.
+        
+        Returns a list of {'name', 'deleted', 'error'} dicts in the same order as instance_names.
+        """
+        try:
+            servers = {}
+            for server in self._call_with_backoff(self.client.servers.list):
+                servers.setdefault(server.name, []).append(server)
+        except Exception, ex:
+            self._log_error("ERROR: Failed to list instances: %s" % str(ex))
+            return [{'name': name, 'deleted': False, 'error': self.get_error()} for name in instance_names]
+        
+        def delete(name):
+            try:
+                assert name in servers, "Instance '%s' not found" % name
+                assert len(servers[name]) == 1, "More than one instance named '%s'" % name
+                self._call_with_backoff(servers[name][0].delete)
+                return {'name': name, 'deleted': True, 'error': None}
+            except Exception, ex:
+                self._log_error("ERROR: Failed to delete instance '%s': %s" % (name, str(ex)))
+                return {'name': name, 'deleted': False, 'error': self.get_error()}
+        
+        return self._run_batch(delete, instance_names, max_workers)
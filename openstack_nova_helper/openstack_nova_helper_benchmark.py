@@ -0,0 +1,211 @@
+"""Benchmark OpenStackNovaHelper against an in-process fake Nova with configurable latency.
+
+For each fleet size, the fake Nova is filled with that many ACTIVE servers and
+list_instances, create_instance, wait_instance_status, create_instances and
+delete_instances are timed. The Nova API calls each one makes are counted from
+the helper's instrumentation. Every fake API call sleeps --latency seconds
+plus --per-item-latency seconds per listed item. New servers become ACTIVE
+after --boot-seconds and get networks --network-delay seconds later. Results
+are written as JSON.
+
+Usage: python openstack_nova_helper_benchmark.py [--sizes 10,100,1000] [--latency 0.01] [--boot-seconds 1]
+                                                 [--output results.json]
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+
+from novaclient import exceptions as nova_exception
+
+from openstack_nova_helper import OpenStackNovaHelper
+
+DEFAULT_SIZES = [10, 100, 1000]
+
+class FakeResource(object):
+    """Nova resource with attributes, its methods make one fake API call each."""
+
+    def __init__(self, manager, **attrs):
+        self.manager = manager
+        self.__dict__.update(attrs)
+
+class FakeServer(FakeResource):
+
+    def __init__(self, manager, active_at, networks_at, **attrs):
+        FakeResource.__init__(self, manager, **attrs)
+        self.active_at = active_at
+        self.networks_at = networks_at
+        self.sg_names = [sg['name'] for sg in attrs['security_groups']]
+
+    @property
+    def status(self):
+        return "ACTIVE" if time.time() >= self.active_at else "BUILD"
+
+    @property
+    def networks(self):
+        return {'defaultnetwork': ['10.0.0.1']} if time.time() >= self.networks_at else {}
+
+    def list_security_group(self):
+        self.manager.nova.request()
+        return [FakeResource(self.manager, name=name) for name in self.sg_names]
+
+    def get_spice_console(self, console_type):
+        self.manager.nova.request()
+        return {'console': {'type': console_type, 'url': 'http://console/%s' % self.id}}
+
+    def delete(self):
+        self.manager.nova.request()
+        self.manager.remove(self)
+
+class FakeManager(object):
+    """List and find of one resource type, find lists and filters like novaclient does."""
+
+    def __init__(self, nova, resources=None):
+        self.nova = nova
+        self.resources = resources or []
+        self.lock = threading.Lock()
+
+    def list(self, detailed=True):
+        with self.lock:
+            resources = list(self.resources)
+        self.nova.request(len(resources))
+        return resources
+
+    def find(self, **kwargs):
+        matches = [resource for resource in self.list()
+                   if all(getattr(resource, key) == value for key, value in kwargs.items())]
+        if not matches:
+            raise nova_exception.NotFound(404, "No %s matching %s" % (self.__class__.__name__, kwargs))
+        if len(matches) > 1:
+            raise nova_exception.NoUniqueMatch()
+        return matches[0]
+
+    def remove(self, resource):
+        with self.lock:
+            self.resources.remove(resource)
+
+class FakeServerManager(FakeManager):
+
+    def add(self, name, image, flavor, security_groups, boot_seconds=None):
+        """Add a server without an API call, ACTIVE at once unless boot_seconds is given."""
+        now = time.time()
+        active_at = now + (boot_seconds if boot_seconds is not None else 0)
+        networks_at = active_at + (self.nova.network_delay if boot_seconds is not None else 0)
+        with self.lock:
+            self.nova.server_ids += 1
+            server = FakeServer(self, active_at, networks_at,
+                                id="server-%i" % self.nova.server_ids, name=name,
+                                image={'id': image}, flavor={'id': flavor},
+                                security_groups=[{'name': group} for group in security_groups],
+                                created=now, updated=now)
+            self.resources.append(server)
+        return server
+
+    def create(self, name, image, flavor, security_groups=None, nics=None):
+        self.nova.request()
+        return self.add(name, image, flavor, security_groups or [], self.nova.boot_seconds)
+
+class FakeNova(object):
+    """In-process stand-in for a novaclient Client, every API call sleeps to simulate latency."""
+
+    def __init__(self, latency=0.01, per_item_latency=0.0, boot_seconds=1.0, network_delay=0.2):
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.boot_seconds = boot_seconds
+        self.network_delay = network_delay
+        self.requests = 0
+        self.server_ids = 0
+        self._lock = threading.Lock()
+
+        now = time.time()
+        self.images = FakeManager(self, [FakeResource(None, id="image-%i" % i, name="image%i" % i,
+                                                      status="ACTIVE", created=now, updated=now) for i in range(20)])
+        self.flavors = FakeManager(self, [FakeResource(None, id="flavor-%s" % name, name=name, vcpus=vcpus, ram=ram, disk=20)
+                                          for name, vcpus, ram in [("m2.tiny", 1, 1024), ("m2.small", 1, 2048),
+                                                                   ("m2.medium", 2, 2048), ("m3.medium", 2, 4096)]])
+        self.networks = FakeManager(self, [FakeResource(None, id="network-1", label="defaultnetwork")])
+        self.security_groups = FakeManager(self, [FakeResource(None, id="sg-1", name="default")])
+        self.floating_ips = FakeManager(self)
+        self.servers = FakeServerManager(self)
+
+    def request(self, items=0):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency + self.per_item_latency * items)
+
+def measure(helper, function, *args, **kwargs):
+    """Call function, return ({'seconds', 'api_calls', 'api'}, return value) for the Nova calls it made."""
+    helper.metrics.reset()
+    start_time = time.time()
+    ret = function(*args, **kwargs)
+    seconds = time.time() - start_time
+    api = dict((method, stats['calls']) for method, stats in helper.api_stats()['api'].items())
+    return {'seconds': seconds, 'api_calls': sum(api.values()), 'api': api}, ret
+
+def run_size(size, args):
+    """Benchmark one fleet size, return dict of results per operation."""
+    nova = FakeNova(args.latency, args.per_item_latency, args.boot_seconds, args.network_delay)
+    for i in range(size):
+        nova.servers.add("fleet-%i" % i, "image-%i" % (i % 20), "flavor-m2.small", ["default"])
+    helper = OpenStackNovaHelper(client=nova)
+    helper.waiter.min_interval = args.poll_interval
+    helper.waiter.max_interval = args.poll_interval * 10
+
+    results = {'fleet_size': size}
+    results['list_instances'], instances = measure(helper, helper.list_instances)
+    assert len(instances) == size
+    # one get_instance per server as list_instances did before, with images and flavors now cached
+    results['list_instances_per_server'], _ = measure(helper, lambda: [helper.get_instance(instance_obj=server)
+                                                                       for server in helper.client.servers.list()])
+
+    results['create_instance'], instance = measure(helper, helper.create_instance, "bench-single", "image0")
+    assert instance is not None, helper.get_error()
+    results['wait_instance_status'], ok = measure(helper, helper.wait_instance_status, "bench-single")
+    assert ok, helper.get_error()
+
+    names = ["bench-batch-%i" % i for i in range(size)]
+    results['create_instances'], created = measure(helper, helper.create_instances,
+                                                   [{'name': name, 'image': "image0"} for name in names],
+                                                   max_workers=args.workers, wait_status="ACTIVE")
+    results['create_instances']['failed'] = sum(1 for result in created if result['error'] is not None)
+    results['delete_instances'], deleted = measure(helper, helper.delete_instances, names, max_workers=args.workers)
+    results['delete_instances']['failed'] = sum(1 for result in deleted if not result['deleted'])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated fleet sizes")
+    parser.add_argument('--latency', type=float, default=0.01, help="seconds per fake API call")
+    parser.add_argument('--per-item-latency', type=float, default=0.00002, help="extra seconds per listed item")
+    parser.add_argument('--boot-seconds', type=float, default=1.0, help="seconds until a new server is ACTIVE")
+    parser.add_argument('--network-delay', type=float, default=0.2, help="seconds from ACTIVE until networks are assigned")
+    parser.add_argument('--poll-interval', type=float, default=0.2, help="minimum status poll interval in seconds")
+    parser.add_argument('--workers', type=int, default=10, help="threads for create_instances and delete_instances")
+    parser.add_argument('--output', help="write JSON results to a file instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = run_size(size, args)
+        print >> sys.stderr, ("%i servers: list_instances %.3fs (%i calls, %i per server), create_instances %.3fs (%i calls)"
+                              % (size, result['list_instances']['seconds'], result['list_instances']['api_calls'],
+                                 result['list_instances_per_server']['api_calls'],
+                                 result['create_instances']['seconds'], result['create_instances']['api_calls']))
+        results.append(result)
+
+    report = json.dumps({'python': platform.python_version(),
+                         'latency': args.latency,
+                         'per_item_latency': args.per_item_latency,
+                         'boot_seconds': args.boot_seconds,
+                         'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
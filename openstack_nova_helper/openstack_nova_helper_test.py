@@ -0,0 +1,96 @@
+import time
+import threading
+import unittest
+
+from openstack_nova_helper import OpenStackNovaHelper
+from openstack_nova_helper_benchmark import FakeNova
+
+class TestInstanceWaiter(unittest.TestCase):
+
+    def setUp(self):
+        self.nova = FakeNova(latency=0, boot_seconds=0.05, network_delay=0.05)
+        self.helper = OpenStackNovaHelper(client=self.nova)
+        self.waiter = self.helper.waiter
+        self.waiter.min_interval = 0.01
+        self.waiter.max_interval = 0.05
+
+    def add_server(self, name, boot_seconds=0.05):
+        return self.nova.servers.add(name, "image-0", "flavor-m2.small", ["default"], boot_seconds)
+
+    def wait_for_thread(self):
+        deadline = time.time() + 5
+        while self.waiter._thread is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(self.waiter._thread)
+
+    def test_wait_instance_status(self):
+        self.add_server("vm1")
+        self.assertTrue(self.helper.wait_instance_status("vm1", timeout_seconds=5))
+        self.assertFalse(self.helper.wait_instance_status("missing", timeout_seconds=5))
+        self.assertEquals(self.helper.get_error(), "Instance 'missing' not found")
+
+    def test_wait_instances_calls_callbacks(self):
+        for i in range(5):
+            self.add_server("vm%i" % i)
+        done = []
+        futures = self.helper.wait_instances(["vm%i" % i for i in range(5)], timeout_seconds=5, callback=done.append)
+        instances = [self.waiter.result(future) for future in futures]
+        self.assertEquals([instance['name'] for instance in instances], ["vm%i" % i for i in range(5)])
+        self.assertEquals(sorted(future.name for future in done), ["vm%i" % i for i in range(5)])
+        self.wait_for_thread()
+        self.assertEquals(self.waiter._statuses, {})
+
+    def test_status_timeout(self):
+        self.add_server("vm1", boot_seconds=60)
+        self.assertFalse(self.helper.wait_instance_status("vm1", timeout_seconds=0.1))
+        self.assertEquals(self.helper.get_error(), "Instance 'vm1' did not get status 'ACTIVE' within 0 seconds")
+
+    def test_networks_wait_past_deadline(self):
+        self.nova.network_delay = 0.3
+        self.add_server("vm1", boot_seconds=0)
+        self.assertTrue(self.helper.wait_instance_status("vm1", timeout_seconds=0.1))
+
+    def test_networks_timeout(self):
+        self.nova.network_delay = 60
+        self.waiter.NETWORK_TIMEOUT = 0.1
+        self.add_server("vm1", boot_seconds=0)
+        self.assertFalse(self.helper.wait_instance_status("vm1", timeout_seconds=0.05))
+        self.assertEquals(self.helper.get_error(), "No networks found for instance 'vm1'")
+
+    def test_failing_poll_fails_pending_futures(self):
+        self.add_server("vm1")
+        poll = self.waiter._poll
+        self.waiter._poll = lambda pending: 1 / 0
+        done = []
+        future = self.waiter.wait("vm1", timeout_seconds=5, callback=done.append)
+        self.assertIsNone(future.result(5))
+        self.assertIn("Waiting for instance 'vm1' failed", future.error)
+        self.assertEquals(done, [future])
+        self.wait_for_thread()
+
+        # the next wait starts a new polling thread
+        self.waiter._poll = poll
+        self.assertTrue(self.helper.wait_instance_status("vm1", timeout_seconds=5))
+
+    def test_stuck_poll_times_out_caller(self):
+        self.add_server("vm1", boot_seconds=60)
+        self.waiter.NETWORK_TIMEOUT = 0
+        poll = self.waiter._poll
+        release = threading.Event()
+        def stuck_poll(pending):
+            changed = poll(pending)
+            release.wait(5)
+            return changed
+        self.waiter._poll = stuck_poll
+
+        start_time = time.time()
+        self.assertFalse(self.helper.wait_instance_status("vm1", timeout_seconds=0.1))
+        self.assertLess(time.time() - start_time, 1)
+        self.assertEquals(self.helper.get_error(), "Timed out waiting for instance 'vm1' to get status 'ACTIVE'")
+
+        release.set()
+        self.wait_for_thread()
+        self.assertEquals(self.waiter._statuses, {})
+
+if __name__ == "__main__":
+    unittest.main()